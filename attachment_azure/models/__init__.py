@@ -2,4 +2,3 @@
 # Copyright 2021 Open Source Integrators
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
 from . import ir_attachment
-from . import ir_binary
@@ -5,20 +5,39 @@ import io
 import logging
 import os
 import re
+import threading
+import time
 from datetime import datetime, timedelta
 
+import requests
+from requests.adapters import HTTPAdapter
+
 from odoo import _, api, exceptions, models
+from odoo.tools import split_every
+from odoo.addons.base_attachment_object_storage.models.ir_attachment import (
+    redirect_expiry,
+)
+from odoo.addons.base_attachment_object_storage.models.ir_binary import (
+    content_disposition,
+)
 
 _logger = logging.getLogger(__name__)
 
 try:
     from azure.storage.blob import (
         BlobServiceClient,
+        BlobSasPermissions,
         generate_account_sas,
+        generate_blob_sas,
         ResourceTypes,
         AccountSasPermissions,
     )
-    from azure.core.exceptions import ResourceExistsError, HttpResponseError
+    from azure.core.exceptions import (
+        HttpResponseError,
+        ResourceExistsError,
+        ResourceNotFoundError,
+    )
+    from azure.core.pipeline.transport import RequestsTransport
 except ImportError:
     _logger.debug("Cannot 'import azure-storage-blob'.")
 
@@ -27,6 +46,116 @@ try:
 except ImportError:
     _logger.debug("Cannot 'import azure-identity'.")
 
+# validity of the account SAS used by the clients
+SAS_EXPIRY = timedelta(hours=1)
+# the clients are renewed this long before the expiry of their SAS
+SAS_RENEW_MARGIN = timedelta(minutes=5)
+# validity of the user delegation keys signing the redirections (AAD)
+DELEGATION_KEY_EXPIRY = timedelta(days=1)
+
+
+class AzureClientStore(object):
+    """Keep in memory the Azure clients of the current process
+
+    Building a blob service client, with a new account SAS or a new
+    credential, and checking that the container exists cost several
+    round-trips for every read, write or delete. The clients are kept
+    here, keyed by their connection parameters, until the expiry of
+    their SAS, and the containers known to exist are remembered. The
+    HTTP sessions are kept as well, so the connections are reused when
+    a client is renewed.
+
+    The store starts over when used in a forked process (workers).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._clients = {}
+        self._sessions = {}
+        self._containers = set()
+        self._delegation_keys = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            self._reset()
+
+    def get_client(self, key, factory):
+        """Return the client of the key
+
+        ``factory`` is called with the HTTP session to use when the client
+        is missing or about to expire. It returns the client and the expiry
+        of its credential, or None when it does not expire.
+        """
+        with self._lock:
+            self._check_pid()
+            client, expiry = self._clients.get(key, (None, None))
+            if client is None or (
+                expiry and expiry - SAS_RENEW_MARGIN <= datetime.utcnow()
+            ):
+                self.misses += 1
+                session = self._sessions.get(key)
+                if session is None:
+                    session = self._sessions[key] = self._new_session()
+                client, expiry = factory(session)
+                self._clients[key] = (client, expiry)
+            else:
+                self.hits += 1
+        return client
+
+    def get_delegation_key(self, key, expiry, factory):
+        """Return the user delegation key of the key, valid until ``expiry``
+
+        ``factory`` is called with the expiry of the new key when the
+        cached one is missing or expires too soon.
+        """
+        with self._lock:
+            self._check_pid()
+            delegation_key, key_expiry = self._delegation_keys.get(key, (None, None))
+            if delegation_key is None or key_expiry - SAS_RENEW_MARGIN <= expiry:
+                key_expiry = max(expiry, datetime.utcnow() + DELEGATION_KEY_EXPIRY)
+                delegation_key = factory(key_expiry)
+                self._delegation_keys[key] = (delegation_key, key_expiry)
+        return delegation_key
+
+    @staticmethod
+    def _new_session():
+        pool_size = int(os.environ.get("AZURE_STORAGE_POOL_SIZE") or 10)
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def is_container_known(self, key, container_name):
+        with self._lock:
+            self._check_pid()
+            return (key, container_name) in self._containers
+
+    def add_container(self, key, container_name):
+        with self._lock:
+            self._check_pid()
+            self._containers.add((key, container_name))
+
+    def stats(self):
+        with self._lock:
+            self._check_pid()
+            return {
+                "pool_hits": self.hits,
+                "pool_misses": self.misses,
+                "clients": len(self._clients),
+                "containers": len(self._containers),
+                "delegation_keys": len(self._delegation_keys),
+            }
+
+
+azure_client_store = AzureClientStore()
+
 
 class IrAttachment(models.Model):
     _inherit = "ir.attachment"
@@ -36,6 +165,25 @@ class IrAttachment(models.Model):
         l += super(IrAttachment, self)._get_stores()
         return l
 
+    @api.model
+    def _object_storage_stats(self):
+        stats = super(IrAttachment, self)._object_storage_stats()
+        stats["azure"] = azure_client_store.stats()
+        return stats
+
+    @api.model
+    def _get_blob_service_client_key(self):
+        return tuple(
+            os.environ.get(name)
+            for name in (
+                "AZURE_STORAGE_CONNECTION_STRING",
+                "AZURE_STORAGE_ACCOUNT_NAME",
+                "AZURE_STORAGE_ACCOUNT_URL",
+                "AZURE_STORAGE_ACCOUNT_KEY",
+                "AZURE_STORAGE_USE_AAD",
+            )
+        )
+
     @api.model
     def _get_blob_service_client(self):
         """Connect to Azure and return the blob service client
@@ -72,16 +220,32 @@ class IrAttachment(models.Model):
                 "* AZURE_STORAGE_USE_AAD\n"
             )
             raise exceptions.UserError(msg)
+        return azure_client_store.get_client(
+            self._get_blob_service_client_key(), self._new_blob_service_client
+        )
+
+    @api.model
+    def _new_blob_service_client(self, session):
+        """Build a blob service client, return it with the expiry of its SAS"""
+        connect_str = os.environ.get("AZURE_STORAGE_CONNECTION_STRING")
+        account_name = os.environ.get("AZURE_STORAGE_ACCOUNT_NAME")
+        account_url = os.environ.get("AZURE_STORAGE_ACCOUNT_URL")
+        account_key = os.environ.get("AZURE_STORAGE_ACCOUNT_KEY")
+        account_use_aad = os.environ.get("AZURE_STORAGE_USE_AAD")
         blob_service_client = None
+        expiry = None
+        client_options = self._get_azure_client_options()
+        client_options["transport"] = self._get_azure_transport(session)
         if account_use_aad:
+            # the credential renews its token by itself
             token_credential = DefaultAzureCredential()
             blob_service_client = BlobServiceClient(
-                account_url=account_url, credential=token_credential
+                account_url=account_url, credential=token_credential, **client_options
             )
         elif connect_str:
             try:
                 blob_service_client = BlobServiceClient.from_connection_string(
-                    connect_str
+                    connect_str, **client_options
                 )
             except HttpResponseError as error:
                 _logger.exception(
@@ -91,16 +255,20 @@ class IrAttachment(models.Model):
                 raise exceptions.UserError(str(error))
         else:
             try:
+                expiry = datetime.utcnow() + SAS_EXPIRY
                 sas_token = generate_account_sas(
                     account_name=account_name,
                     account_key=account_key,
                     resource_types=ResourceTypes(container=True, object=True),
-                    permission=AccountSasPermissions(read=True, write=True),
-                    expiry=datetime.utcnow() + timedelta(hours=1),
+                    permission=AccountSasPermissions(
+                        read=True, write=True, delete=True, create=True
+                    ),
+                    expiry=expiry,
                 )
                 blob_service_client = BlobServiceClient(
                     account_url=account_url,
                     credential=sas_token,
+                    **client_options
                 )
             except HttpResponseError as error:
                 _logger.exception(
@@ -108,7 +276,62 @@ class IrAttachment(models.Model):
                     "Access Signature (SAS)"
                 )
                 raise exceptions.UserError(str(error))
-        return blob_service_client
+        return blob_service_client, expiry
+
+    @api.model
+    def _get_azure_transport(self, session):
+        """HTTP transport of the blob service client
+
+        The connections are kept alive in the pool of the session, of
+        ``AZURE_STORAGE_POOL_SIZE`` connections (default 10). The timeouts
+        in seconds can be changed with ``AZURE_STORAGE_CONNECT_TIMEOUT``
+        and ``AZURE_STORAGE_READ_TIMEOUT``.
+        """
+        options = {"session": session, "session_owner": False}
+        connect_timeout = os.environ.get("AZURE_STORAGE_CONNECT_TIMEOUT")
+        if connect_timeout:
+            options["connection_timeout"] = float(connect_timeout)
+        read_timeout = os.environ.get("AZURE_STORAGE_READ_TIMEOUT")
+        if read_timeout:
+            options["read_timeout"] = float(read_timeout)
+        return RequestsTransport(**options)
+
+    @api.model
+    def _get_azure_client_options(self):
+        """Options of the blob service client for the uploads
+
+        * ``AZURE_STORAGE_MAX_SINGLE_PUT_SIZE``: size in bytes from which a
+          file is uploaded in blocks (SDK default 64 MiB)
+        * ``AZURE_STORAGE_MAX_BLOCK_SIZE``: size of the blocks in bytes (SDK
+          default 4 MiB)
+
+        And for the downloads:
+
+        * ``AZURE_STORAGE_MAX_SINGLE_GET_SIZE``: size in bytes read by the
+          first request of a download, the rest is read by chunks (SDK
+          default 32 MiB)
+        * ``AZURE_STORAGE_MAX_CHUNK_GET_SIZE``: size of the chunks in bytes
+          (SDK default 4 MiB)
+        """
+        options = {}
+        for option, name in (
+            ("max_single_put_size", "AZURE_STORAGE_MAX_SINGLE_PUT_SIZE"),
+            ("max_block_size", "AZURE_STORAGE_MAX_BLOCK_SIZE"),
+            ("max_single_get_size", "AZURE_STORAGE_MAX_SINGLE_GET_SIZE"),
+            ("max_chunk_get_size", "AZURE_STORAGE_MAX_CHUNK_GET_SIZE"),
+        ):
+            value = os.environ.get(name)
+            if value:
+                options[option] = int(value)
+        return options
+
+    @staticmethod
+    def _get_azure_max_concurrency():
+        return int(os.environ.get("AZURE_STORAGE_MAX_CONCURRENCY") or 4)
+
+    @staticmethod
+    def _get_azure_copy_timeout():
+        return int(os.environ.get("AZURE_STORAGE_COPY_TIMEOUT") or 600)
 
     @api.model
     def _get_container_name(self):
@@ -125,7 +348,12 @@ class IrAttachment(models.Model):
         return str.lower(storage_name)[:63]
 
     @api.model
-    def _get_azure_container(self, container_name=None):
+    def _get_azure_container(self, container_name=None, create=True):
+        """Return the client of the container, create the container if missing
+
+        With ``create=False``, the container is expected to exist and is
+        neither checked nor created.
+        """
         if not container_name:
             container_name = self._get_container_name()
         try:
@@ -137,17 +365,26 @@ class IrAttachment(models.Model):
             )
             return False
         container_client = blob_service_client.get_container_client(container_name)
+        client_key = self._get_blob_service_client_key()
+        if not create or azure_client_store.is_container_known(
+            client_key, container_name
+        ):
+            return container_client
         if not container_client.exists():
             try:
                 # Create the container
                 container_client.create_container()
+            except ResourceExistsError:
+                # created by another process in the meantime
+                pass
             except HttpResponseError as error:
                 _logger.exception("Error during the creation of the Azure container")
                 raise exceptions.UserError(str(error))
+        azure_client_store.add_container(client_key, container_name)
         return container_client
 
     @api.model
-    def _store_file_read(self, fname, bin_size=False):
+    def _store_file_read(self, fname):
         if fname.startswith("azure://"):
             key = fname.replace("azure://", "", 1).lower()
             if "/" in key:
@@ -160,37 +397,214 @@ class IrAttachment(models.Model):
                 return ""
             try:
                 blob_client = container_client.get_blob_client(key)
-                read = blob_client.download_blob().readall()
+                # the chunks of large files are downloaded in parallel
+                read = blob_client.download_blob(
+                    max_concurrency=self._get_azure_max_concurrency()
+                ).readall()
+            except ResourceNotFoundError:
+                read = ""
+                self._store_file_missing(fname)
             except HttpResponseError:
                 read = ""
-                _logger.info("Attachment '%s' missing on object storage", fname)
+                _logger.exception("Error reading the file %s" % fname)
             return read
         else:
-            return super(IrAttachment, self)._store_file_read(fname, bin_size)
+            return super(IrAttachment, self)._store_file_read(fname)
+
+    @api.model
+    def _store_file_read_iter(self, fname, start=0, chunk_size=None):
+        if fname.startswith("azure://"):
+            key = fname.replace("azure://", "", 1).lower()
+            if "/" in key:
+                container_name, key = key.split("/", 1)
+            else:
+                container_name = None
+            container_client = self._get_azure_container(container_name)
+            if not container_client:
+                return iter(())
+            try:
+                blob_client = container_client.get_blob_client(key)
+                # the size of the chunks is AZURE_STORAGE_MAX_CHUNK_GET_SIZE
+                downloader = blob_client.download_blob(offset=start or None)
+            except ResourceNotFoundError:
+                self._store_file_missing(fname)
+                return iter(())
+            except HttpResponseError:
+                _logger.exception("Error reading the file %s" % fname)
+                return iter(())
+            return downloader.chunks()
+        else:
+            return super(IrAttachment, self)._store_file_read_iter(
+                fname, start=start, chunk_size=chunk_size
+            )
+
+    @api.model
+    def _store_file_redirect_url(
+        self, fname, download_name=None, mimetype=None, as_attachment=False
+    ):
+        if fname.startswith("azure://"):
+            key = fname.replace("azure://", "", 1).lower()
+            if "/" in key:
+                container_name, key = key.split("/", 1)
+            else:
+                container_name = None
+            container_client = self._get_azure_container(container_name)
+            if not container_client:
+                return None
+            blob_client = container_client.get_blob_client(key)
+            expiry = datetime.utcnow() + timedelta(seconds=redirect_expiry())
+            sas_params = {
+                "account_name": blob_client.account_name,
+                "container_name": blob_client.container_name,
+                "blob_name": blob_client.blob_name,
+                "permission": BlobSasPermissions(read=True),
+                "expiry": expiry,
+            }
+            if mimetype:
+                sas_params["content_type"] = mimetype
+            if download_name:
+                sas_params["content_disposition"] = content_disposition(
+                    download_name, as_attachment=as_attachment
+                )
+            account_key = os.environ.get("AZURE_STORAGE_ACCOUNT_KEY") or getattr(
+                blob_client.credential, "account_key", None
+            )
+            try:
+                if account_key:
+                    sas_token = generate_blob_sas(account_key=account_key, **sas_params)
+                elif os.environ.get("AZURE_STORAGE_USE_AAD"):
+                    # one key signs the redirections until shortly before
+                    # its expiry
+                    blob_service_client = self._get_blob_service_client()
+                    delegation_key = azure_client_store.get_delegation_key(
+                        self._get_blob_service_client_key(),
+                        expiry,
+                        lambda key_expiry: blob_service_client.get_user_delegation_key(
+                            key_start_time=datetime.utcnow(), key_expiry_time=key_expiry
+                        ),
+                    )
+                    sas_token = generate_blob_sas(
+                        user_delegation_key=delegation_key, **sas_params
+                    )
+                else:
+                    return None
+            except HttpResponseError:
+                _logger.exception("Error generating a SAS for the file %s" % fname)
+                return None
+            return "%s?%s" % (blob_client.url, sas_token)
+        else:
+            return super(IrAttachment, self)._store_file_redirect_url(
+                fname,
+                download_name=download_name,
+                mimetype=mimetype,
+                as_attachment=as_attachment,
+            )
+
+    @api.model
+    def _store_file_name(self, key):
+        location = self.env.context.get("storage_location") or self._storage()
+        if location == "azure":
+            return "azure://%s/%s" % (self._get_container_name(), key)
+        return super(IrAttachment, self)._store_file_name(key)
+
+    @api.model
+    def _store_file_exists(self, fname):
+        if fname.startswith("azure://"):
+            key = fname.replace("azure://", "", 1).lower()
+            if "/" in key:
+                container_name, key = key.split("/", 1)
+            else:
+                container_name = None
+            container_client = self._get_azure_container(container_name)
+            if not container_client:
+                return False
+            try:
+                return container_client.get_blob_client(key).exists()
+            except HttpResponseError:
+                return False
+        return super(IrAttachment, self)._store_file_exists(fname)
+
+    @api.model
+    def _store_file_copy(self, fname, key):
+        if fname.startswith("azure://"):
+            source_key = fname.replace("azure://", "", 1).lower()
+            if "/" in source_key:
+                source_container, source_key = source_key.split("/", 1)
+            else:
+                source_container = None
+            # the source is only read, it must not be created
+            source_client = self._get_azure_container(source_container, create=False)
+            container_client = self._get_azure_container()
+            if not (source_client and container_client):
+                raise exceptions.UserError(_("Error accessing the Azure storage"))
+            source_url = source_client.get_blob_client(source_key).url
+            blob_client = container_client.get_blob_client(key.lower())
+            # the copy is done by the storage, wait for its end
+            copy = blob_client.start_copy_from_url(source_url)
+            status = copy["copy_status"]
+            deadline = time.monotonic() + self._get_azure_copy_timeout()
+            while status == "pending":
+                if time.monotonic() >= deadline:
+                    try:
+                        blob_client.abort_copy(copy["copy_id"])
+                        status = "timeout"
+                    except HttpResponseError:
+                        # finished in the meantime, the status says how
+                        status = blob_client.get_blob_properties().copy.status
+                    break
+                time.sleep(1)
+                status = blob_client.get_blob_properties().copy.status
+            if status != "success":
+                raise exceptions.UserError(
+                    _("The copy of the file %s failed: %s") % (fname, status)
+                )
+            return "azure://%s/%s" % (container_client.container_name, key)
+        return super(IrAttachment, self)._store_file_copy(fname, key)
 
     @api.model
     def _store_file_write(self, key, bin_data):
+        location = self.env.context.get("storage_location") or self._storage()
+        if location == "azure":
+            # the buffer is shared with bin_data as long as it is not written
+            with io.BytesIO(bin_data) as file:
+                filename = self._store_file_write_fileobj(key, file, len(bin_data))
+        else:
+            _super = super(IrAttachment, self)
+            filename = _super._store_file_write(key, bin_data)
+        return filename
+
+    @api.model
+    def _store_file_write_fileobj(self, key, fileobj, size):
         location = self.env.context.get("storage_location") or self._storage()
         if location == "azure":
             container_client = self._get_azure_container()
             filename = "azure://%s/%s" % (container_client.container_name, key)
-            with io.BytesIO() as file:
-                blob_client = container_client.get_blob_client(key.lower())
-                file.write(bin_data)
-                file.seek(0)
-                try:
-                    blob_client.upload_blob(file, blob_type="BlockBlob")
-                except ResourceExistsError:
-                    pass
-                except HttpResponseError as error:
-                    # log verbose error from azure, return short message for user
-                    _logger.exception("Error during storage of the file %s" % filename)
-                    raise exceptions.UserError(
-                        _("The file could not be stored: %s") % str(error)
-                    )
+            blob_client = container_client.get_blob_client(key.lower())
+            # the content of a checksum key never changes, a forced key
+            # (force_storage_key) is rewritten with its new content
+            overwrite = bool(self.env.context.get("force_storage_key"))
+            try:
+                # blocks of large files are read from the file object and
+                # uploaded in parallel
+                blob_client.upload_blob(
+                    fileobj,
+                    blob_type="BlockBlob",
+                    length=size,
+                    overwrite=overwrite,
+                    max_concurrency=self._get_azure_max_concurrency(),
+                )
+            except ResourceExistsError:
+                if overwrite:
+                    raise
+            except HttpResponseError as error:
+                # log verbose error from azure, return short message for user
+                _logger.exception("Error during storage of the file %s" % filename)
+                raise exceptions.UserError(
+                    _("The file could not be stored: %s") % str(error)
+                )
         else:
             _super = super(IrAttachment, self)
-            filename = _super._store_file_write(key, bin_data)
+            filename = _super._store_file_write_fileobj(key, fileobj, size)
         return filename
 
     @api.model
@@ -216,3 +630,40 @@ class IrAttachment(models.Model):
                 _logger.exception("Error during deletion of the file %s" % fname)
         else:
             super(IrAttachment, self)._store_file_delete(fname)
+
+    @api.model
+    def _store_files_delete(self, fnames):
+        azure_fnames = [fname for fname in fnames if fname.startswith("azure://")]
+        others = [fname for fname in fnames if not fname.startswith("azure://")]
+        if azure_fnames:
+            container_client = self._get_azure_container()
+            if not container_client:
+                return
+            # delete the files only if they are on the current configured
+            # container otherwise, we might delete files used on a different
+            # environment
+            container_name = container_client.container_name
+            blob_names = []
+            for fname in azure_fnames:
+                key = fname.replace("azure://", "", 1).lower()
+                if "/" in key:
+                    key_container, key = key.split("/", 1)
+                else:
+                    key_container = container_name
+                if key_container == container_name:
+                    blob_names.append(key)
+            # a batch request accepts up to 256 sub-requests
+            for chunk in split_every(256, blob_names):
+                try:
+                    container_client.delete_blobs(*chunk)
+                    _logger.info(
+                        "%d files deleted on the object storage", len(chunk)
+                    )
+                except HttpResponseError:
+                    # raised as well when some of the files were already
+                    # deleted
+                    _logger.exception(
+                        "Error during deletion of %d files" % len(chunk)
+                    )
+        if others:
+            super(IrAttachment, self)._store_files_delete(others)
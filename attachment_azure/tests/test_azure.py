@@ -0,0 +1,55 @@
+# Copyright 2016-2019 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+from unittest import mock
+
+from odoo.tests.common import TransactionCase
+
+
+class TestAttachmentAzure(TransactionCase):
+    def setUp(self):
+        super().setUp()
+        self.Attachment = self.env["ir.attachment"].with_context(
+            storage_location="azure"
+        )
+        self.container_client = mock.MagicMock()
+        self.container_client.container_name = "test-db"
+        self.blob_client = self.container_client.get_blob_client.return_value
+        patcher = mock.patch.object(
+            type(self.Attachment),
+            "_get_azure_container",
+            return_value=self.container_client,
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_write_checksum_key(self):
+        """A file with the key of its checksum is never overwritten"""
+        fname = self.Attachment._store_file_write("abcd", b"content")
+        self.assertEqual(fname, "azure://test-db/abcd")
+        self.blob_client.upload_blob.assert_called_once_with(
+            mock.ANY,
+            blob_type="BlockBlob",
+            length=7,
+            overwrite=False,
+            max_concurrency=mock.ANY,
+        )
+
+    def test_write_forced_key(self):
+        """A forced key is rewritten with its new content"""
+        uploaded = []
+        self.blob_client.upload_blob.side_effect = (
+            lambda fileobj, **kwargs: uploaded.append(fileobj.read())
+        )
+        fname = self.Attachment.with_context(
+            force_storage_key="my/key"
+        )._store_file_write("my/key", b"new content")
+        self.assertEqual(fname, "azure://test-db/my/key")
+        self.blob_client.upload_blob.assert_called_once_with(
+            mock.ANY,
+            blob_type="BlockBlob",
+            length=11,
+            overwrite=True,
+            max_concurrency=mock.ANY,
+        )
+        self.assertEqual(uploaded, [b"new content"])
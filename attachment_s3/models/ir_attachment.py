@@ -5,23 +5,161 @@
 import logging
 import os
 import io
+import threading
+from contextlib import closing
 from urllib.parse import urlsplit
 
 from odoo import _, api, exceptions, models
+from odoo.tools import split_every
+from odoo.addons.base_attachment_object_storage.models.ir_attachment import (
+    ClosingIterator,
+    redirect_expiry,
+)
+from odoo.addons.base_attachment_object_storage.models.ir_binary import (
+    content_disposition,
+)
 from ..s3uri import S3Uri
 
 _logger = logging.getLogger(__name__)
 
 try:
     import boto3
+    from boto3.s3.transfer import TransferConfig
+    from botocore.config import Config
     from botocore.exceptions import ClientError, EndpointConnectionError
 except ImportError:
     boto3 = None  # noqa
+    TransferConfig = None  # noqa
+    Config = None  # noqa
     ClientError = None  # noqa
     EndpointConnectionError = None  # noqa
     _logger.debug("Cannot 'import boto3'.")
 
 
+class S3ClientStore(object):
+    """Keep in memory the S3 connections of the current process
+
+    Building a boto3 resource creates a new session and a new client,
+    with its own connection pool, and checking that the bucket exists
+    costs one more round-trip. Doing it for every read, write or
+    delete is expensive, so the clients are kept here, keyed by their
+    connection parameters, and the buckets known to exist are
+    remembered.
+
+    The clients are thread-safe, the resources are not: each call to
+    ``get_resource`` returns a new resource, cheap to build, sharing the
+    client of the process, so the threads of the pools never share a
+    resource.
+
+    Connection pools must not be shared between processes: when the
+    store is used in a forked process (workers), it starts over with
+    an empty store.
+
+    The pool can be tuned with the following environment variables:
+    * ``AWS_MAX_POOL_CONNECTIONS`` (default 10)
+    * ``AWS_CONNECT_TIMEOUT`` in seconds (default 60)
+    * ``AWS_READ_TIMEOUT`` in seconds (default 60)
+
+    Retries are configured by botocore itself with ``AWS_MAX_ATTEMPTS``
+    and ``AWS_RETRY_MODE``.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._clients = {}
+        self._buckets = set()
+        self.hits = 0
+        self.misses = 0
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            self._reset()
+
+    def _get_key(self, params):
+        return tuple(sorted(params.items()))
+
+    def _get_config(self):
+        return Config(
+            max_pool_connections=int(
+                os.environ.get('AWS_MAX_POOL_CONNECTIONS') or 10
+            ),
+            connect_timeout=float(os.environ.get('AWS_CONNECT_TIMEOUT') or 60),
+            read_timeout=float(os.environ.get('AWS_READ_TIMEOUT') or 60),
+        )
+
+    def get_resource(self, **params):
+        """Return a new S3 service resource matching the parameters
+
+        The resource must not be shared between threads, its client is
+        shared by the whole process.
+        """
+        key = self._get_key(params)
+        with self._lock:
+            self._check_pid()
+            cached = self._clients.get(key)
+            if cached is None:
+                self.misses += 1
+                # sessions are not thread-safe, each client gets its own
+                session = boto3.session.Session()
+                s3 = session.resource(
+                    's3', config=self._get_config(), **params
+                )
+                cached = (s3.meta.client, type(s3))
+                self._clients[key] = cached
+            else:
+                self.hits += 1
+        client, resource_class = cached
+        return resource_class(client=client)
+
+    def is_bucket_known(self, bucket_name, **params):
+        key = (self._get_key(params), bucket_name)
+        with self._lock:
+            self._check_pid()
+            return key in self._buckets
+
+    def add_bucket(self, bucket_name, **params):
+        key = (self._get_key(params), bucket_name)
+        with self._lock:
+            self._check_pid()
+            self._buckets.add(key)
+
+    def stats(self):
+        with self._lock:
+            self._check_pid()
+            return {
+                'pool_hits': self.hits,
+                'pool_misses': self.misses,
+                'clients': len(self._clients),
+                'buckets': len(self._buckets),
+            }
+
+
+s3_client_store = S3ClientStore()
+
+
+def s3_transfer_config():
+    """Return the configuration of the uploads
+
+    Files above ``AWS_MULTIPART_THRESHOLD`` bytes (default 8 MiB) are
+    uploaded in parts of ``AWS_MULTIPART_CHUNKSIZE`` bytes (default
+    8 MiB), ``AWS_MAX_CONCURRENCY`` parts at a time (default 10).
+    """
+    mib = 1024 * 1024
+    return TransferConfig(
+        multipart_threshold=int(
+            os.environ.get('AWS_MULTIPART_THRESHOLD') or 8 * mib
+        ),
+        multipart_chunksize=int(
+            os.environ.get('AWS_MULTIPART_CHUNKSIZE') or 8 * mib
+        ),
+        max_concurrency=int(os.environ.get('AWS_MAX_CONCURRENCY') or 10),
+    )
+
+
 class IrAttachment(models.Model):
     _inherit = "ir.attachment"
 
@@ -30,6 +168,20 @@ class IrAttachment(models.Model):
         l += super()._get_stores()
         return l
 
+    @api.model
+    def _object_storage_stats(self):
+        stats = super()._object_storage_stats()
+        stats['s3'] = s3_client_store.stats()
+        return stats
+
+    @api.model
+    def _get_s3_bucket_name(self, name=None):
+        bucket_name = name or os.environ.get('AWS_BUCKETNAME')
+        if not bucket_name:
+            return bucket_name
+        # replaces {db} by the database name to handle multi-tenancy
+        return bucket_name.format(db=self.env.cr.dbname)
+
     @api.model
     def _get_s3_bucket(self, name=None):
         """Connect to S3 and return the bucket
@@ -54,9 +206,7 @@ class IrAttachment(models.Model):
         region_name = os.environ.get('AWS_REGION')
         access_key = os.environ.get('AWS_ACCESS_KEY_ID')
         secret_key = os.environ.get('AWS_SECRET_ACCESS_KEY')
-        bucket_name = name or os.environ.get('AWS_BUCKETNAME')
-        # replaces {db} by the database name to handle multi-tenancy
-        bucket_name = bucket_name.format(db=self.env.cr.dbname)
+        bucket_name = self._get_s3_bucket_name(name=name)
 
         params = {
             'aws_access_key_id': access_key,
@@ -79,9 +229,10 @@ class IrAttachment(models.Model):
                     ) % (bucket_name, bucket_name)
 
             raise exceptions.UserError(msg)
-        # try:
-        s3 = boto3.resource('s3', **params)
+        s3 = s3_client_store.get_resource(**params)
         bucket = s3.Bucket(bucket_name)
+        if s3_client_store.is_bucket_known(bucket_name, **params):
+            return bucket
         exists = True
         try:
             s3.meta.client.head_bucket(Bucket=bucket_name)
@@ -105,6 +256,7 @@ class IrAttachment(models.Model):
                     CreateBucketConfiguration={
                         'LocationConstraint': region_name
                     })
+        s3_client_store.add_bucket(bucket_name, **params)
         return bucket
 
     @api.model
@@ -119,46 +271,169 @@ class IrAttachment(models.Model):
                 )
                 return ''
             try:
-                key = s3uri.item()
-                bucket.meta.client.head_object(
-                    Bucket=bucket.name, Key=key
+                # a single GET, the body is read at once in a buffer of
+                # the size of the object
+                response = bucket.meta.client.get_object(
+                    Bucket=bucket.name, Key=s3uri.item()
                 )
-                with io.BytesIO() as res:
-                    bucket.download_fileobj(key, res)
-                    res.seek(0)
-                    read = res.read()
-            except ClientError:
+                with closing(response['Body']) as body:
+                    read = body.read()
+            except ClientError as error:
                 read = ''
-                _logger.info(
-                    "attachment '%s' missing on object storage", fname
-                )
+                self._s3_log_read_error(fname, error)
             return read
         else:
             return super()._store_file_read(fname)
 
+    @api.model
+    def _store_file_read_iter(self, fname, start=0, chunk_size=None):
+        if fname.startswith('s3://'):
+            s3uri = S3Uri(fname)
+            try:
+                bucket = self._get_s3_bucket(name=s3uri.bucket())
+            except exceptions.UserError:
+                _logger.exception(
+                    "error reading attachment '%s' from object storage", fname
+                )
+                return iter(())
+            params = {'Bucket': bucket.name, 'Key': s3uri.item()}
+            if start:
+                params['Range'] = 'bytes=%d-' % start
+            try:
+                response = bucket.meta.client.get_object(**params)
+            except ClientError as error:
+                self._s3_log_read_error(fname, error)
+                return iter(())
+            return self._s3_iter_body(response['Body'], chunk_size)
+        else:
+            return super()._store_file_read_iter(
+                fname, start=start, chunk_size=chunk_size
+            )
+
+    def _s3_log_read_error(self, fname, error):
+        if error.response['Error']['Code'] in ('NoSuchKey', '404'):
+            self._store_file_missing(fname)
+        else:
+            _logger.exception(
+                "error reading attachment '%s' from object storage", fname
+            )
+
+    @staticmethod
+    def _s3_iter_body(body, chunk_size):
+        # the connection is given back to the pool once the body has been
+        # consumed or closed, even if it has never been read
+        return ClosingIterator(
+            body.iter_chunks(chunk_size or 1024 * 1024), body
+        )
+
+    @api.model
+    def _store_file_redirect_url(
+        self, fname, download_name=None, mimetype=None, as_attachment=False
+    ):
+        if fname.startswith('s3://'):
+            s3uri = S3Uri(fname)
+            try:
+                bucket = self._get_s3_bucket(name=s3uri.bucket())
+            except exceptions.UserError:
+                _logger.exception(
+                    "error reading attachment '%s' from object storage", fname
+                )
+                return None
+            params = {'Bucket': bucket.name, 'Key': s3uri.item()}
+            if mimetype:
+                params['ResponseContentType'] = mimetype
+            if download_name:
+                params['ResponseContentDisposition'] = content_disposition(
+                    download_name, as_attachment=as_attachment
+                )
+            try:
+                return bucket.meta.client.generate_presigned_url(
+                    'get_object', Params=params, ExpiresIn=redirect_expiry()
+                )
+            except ClientError:
+                _logger.exception(
+                    "error generating a presigned url for '%s'", fname
+                )
+                return None
+        else:
+            return super()._store_file_redirect_url(
+                fname,
+                download_name=download_name,
+                mimetype=mimetype,
+                as_attachment=as_attachment,
+            )
+
+    @api.model
+    def _store_file_name(self, key):
+        location = self.env.context.get('storage_location') or self._storage()
+        if location == 's3':
+            bucket_name = self._get_s3_bucket_name()
+            return bucket_name and 's3://%s/%s' % (bucket_name, key)
+        return super()._store_file_name(key)
+
+    @api.model
+    def _store_file_exists(self, fname):
+        if fname.startswith('s3://'):
+            s3uri = S3Uri(fname)
+            try:
+                bucket = self._get_s3_bucket(name=s3uri.bucket())
+                bucket.meta.client.head_object(
+                    Bucket=bucket.name, Key=s3uri.item()
+                )
+            except (ClientError, exceptions.UserError):
+                return False
+            return True
+        return super()._store_file_exists(fname)
+
+    @api.model
+    def _store_file_copy(self, fname, key):
+        if fname.startswith('s3://'):
+            s3uri = S3Uri(fname)
+            bucket = self._get_s3_bucket()
+            # large objects are copied by parts, on the server side
+            bucket.Object(key=key).copy(
+                {'Bucket': s3uri.bucket(), 'Key': s3uri.item()},
+                Config=s3_transfer_config(),
+            )
+            return 's3://%s/%s' % (bucket.name, key)
+        return super()._store_file_copy(fname, key)
+
     @api.model
     def _store_file_write(self, key, bin_data):
+        location = self.env.context.get('storage_location') or self._storage()
+        if location == 's3':
+            # the buffer is shared with bin_data as long as it is not written
+            with io.BytesIO(bin_data) as file:
+                filename = self._store_file_write_fileobj(
+                    key, file, len(bin_data)
+                )
+        else:
+            _super = super()
+            filename = _super._store_file_write(key, bin_data)
+        return filename
+
+    @api.model
+    def _store_file_write_fileobj(self, key, fileobj, size):
         location = self.env.context.get('storage_location') or self._storage()
         if location == 's3':
             bucket = self._get_s3_bucket()
             obj = bucket.Object(key=key)
-            with io.BytesIO() as file:
-                file.write(bin_data)
-                file.seek(0)
-                filename = 's3://%s/%s' % (bucket.name, key)
-                try:
-                    obj.upload_fileobj(file)
-                except ClientError as error:
-                    # log verbose error from s3, return short message for user
-                    _logger.exception(
-                        'Error during storage of the file %s' % filename
-                    )
-                    raise exceptions.UserError(
-                        _('The file could not be stored: %s') % str(error)
-                    )
+            filename = 's3://%s/%s' % (bucket.name, key)
+            try:
+                # large files are uploaded by parts, read from the file
+                # object as they are sent
+                obj.upload_fileobj(fileobj, Config=s3_transfer_config())
+            except ClientError as error:
+                # log verbose error from s3, return short message for user
+                _logger.exception(
+                    'Error during storage of the file %s' % filename
+                )
+                raise exceptions.UserError(
+                    _('The file could not be stored: %s') % str(error)
+                )
         else:
             _super = super()
-            filename = _super._store_file_write(key, bin_data)
+            filename = _super._store_file_write_fileobj(key, fileobj, size)
         return filename
 
     @api.model
@@ -169,13 +444,12 @@ class IrAttachment(models.Model):
             item_name = s3uri.item()
             # delete the file only if it is on the current configured bucket
             # otherwise, we might delete files used on a different environment
-            if bucket_name == os.environ.get('AWS_BUCKETNAME'):
+            if bucket_name == self._get_s3_bucket_name():
                 bucket = self._get_s3_bucket()
                 obj = bucket.Object(key=item_name)
                 try:
-                    bucket.meta.client.head_object(
-                        Bucket=bucket.name, Key=item_name
-                    )
+                    # deleting a missing key is not an error on S3, no need
+                    # to check its existence first
                     obj.delete()
                     _logger.info(
                         'file %s deleted on the object storage' % (fname,)
@@ -188,3 +462,45 @@ class IrAttachment(models.Model):
                     )
         else:
             super()._store_file_delete(fname)
+
+    @api.model
+    def _store_files_delete(self, fnames):
+        s3_fnames = [fname for fname in fnames if fname.startswith('s3://')]
+        others = [fname for fname in fnames if not fname.startswith('s3://')]
+        if s3_fnames:
+            bucket = self._get_s3_bucket()
+            # delete the files only if they are on the current configured
+            # bucket otherwise, we might delete files used on a different
+            # environment
+            keys = []
+            for fname in s3_fnames:
+                s3uri = S3Uri(fname)
+                if s3uri.bucket() == bucket.name:
+                    keys.append(s3uri.item())
+            client = bucket.meta.client
+            # DeleteObjects accepts up to 1000 keys per request
+            for chunk in split_every(1000, keys):
+                try:
+                    response = client.delete_objects(
+                        Bucket=bucket.name,
+                        Delete={
+                            'Objects': [{'Key': key} for key in chunk],
+                            'Quiet': True,
+                        },
+                    )
+                except ClientError:
+                    _logger.exception(
+                        'Error during deletion of %d files', len(chunk)
+                    )
+                    continue
+                for error in response.get('Errors', []):
+                    _logger.error(
+                        'Error during deletion of the file %s: %s',
+                        error.get('Key'), error.get('Message'),
+                    )
+                _logger.info(
+                    '%d files deleted on the object storage',
+                    len(chunk) - len(response.get('Errors', [])),
+                )
+        if others:
+            super()._store_files_delete(others)
@@ -0,0 +1,63 @@
+# Copyright 2017-2019 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+import os
+from unittest import mock
+
+from odoo.tests.common import TransactionCase
+
+
+class TestAttachmentS3(TransactionCase):
+
+    def setUp(self):
+        super().setUp()
+        self.Attachment = self.env['ir.attachment']
+        # the name of the bucket depends on the database
+        patcher = mock.patch.dict(os.environ, {'AWS_BUCKETNAME': '{db}-files'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.bucket_name = '%s-files' % self.env.cr.dbname
+        self.bucket = mock.MagicMock()
+        self.bucket.name = self.bucket_name
+        patcher = mock.patch.object(
+            type(self.Attachment), '_get_s3_bucket', return_value=self.bucket
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_delete_file_of_templated_bucket(self):
+        self.Attachment._store_file_delete(
+            's3://%s/tmp/abcd' % self.bucket_name
+        )
+        self.bucket.Object.assert_called_once_with(key='tmp/abcd')
+        self.bucket.Object.return_value.delete.assert_called_once_with()
+
+    def test_delete_file_of_other_bucket(self):
+        """Files of other environments are never deleted"""
+        self.Attachment._store_file_delete('s3://other-files/tmp/abcd')
+        self.Attachment._store_file_delete('s3://{db}-files/tmp/abcd')
+        self.bucket.Object.assert_not_called()
+
+    def test_read_iter_closed_before_reading(self):
+        """The body of an unread response is closed with the iterator"""
+        body = mock.MagicMock()
+        body.iter_chunks.return_value = iter([b'con', b'tent'])
+        self.bucket.meta.client.get_object.return_value = {'Body': body}
+        chunks = self.Attachment._store_file_read_iter(
+            's3://%s/abcd' % self.bucket_name, start=3
+        )
+        self.bucket.meta.client.get_object.assert_called_once_with(
+            Bucket=self.bucket_name, Key='abcd', Range='bytes=3-'
+        )
+        chunks.close()
+        body.close.assert_called_once_with()
+
+    def test_read_iter(self):
+        body = mock.MagicMock()
+        body.iter_chunks.return_value = iter([b'con', b'tent'])
+        self.bucket.meta.client.get_object.return_value = {'Body': body}
+        chunks = self.Attachment._store_file_read_iter(
+            's3://%s/abcd' % self.bucket_name
+        )
+        self.assertEqual(list(chunks), [b'con', b'tent'])
+        body.close.assert_called_once_with()
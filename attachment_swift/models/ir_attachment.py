@@ -2,16 +2,28 @@
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
 
 
+import io
+import json
 import logging
 import os
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import ExitStack, contextmanager
+from urllib.parse import quote, urlsplit
 from ..swift_uri import SwiftUri
 
 from odoo import api, exceptions, models, _
+from odoo.tools import split_every
+from odoo.addons.base_attachment_object_storage.models.ir_attachment import (
+    ClosingIterator,
+    redirect_expiry,
+)
 
 _logger = logging.getLogger(__name__)
 
 try:
     import swiftclient
+    import swiftclient.utils
     import keystoneauth1
     import keystoneauth1.identity
     import keystoneauth1.session
@@ -23,6 +35,15 @@ except ImportError:
 
 
 SWIFT_TIMEOUT = 15
+# the default maximum of the bulk-delete middleware is 10000
+SWIFT_BULK_DELETE_SIZE = 1000
+# size of the reads of the file objects uploaded in a single request
+SWIFT_PUT_CHUNK_SIZE = 1024 * 1024
+
+
+def swift_segments_container(container):
+    """Container of the segments of the large objects of a container"""
+    return '{}_segments'.format(container)
 
 
 class SwiftSessionStore(object):
@@ -72,6 +93,100 @@ class SwiftSessionStore(object):
 swift_session_store = SwiftSessionStore()
 
 
+class SwiftConnectionPool(object):
+    """Keep in memory the idle Swift connections of the current process
+
+    A Swift connection keeps its HTTP connection alive between requests
+    but it is not thread-safe: a connection is taken from the pool for
+    an operation and given back afterwards, keyed by its connection
+    parameters. At most ``SWIFT_POOL_SIZE`` (default 10) idle connections
+    are kept per key.
+
+    The containers created by the process are remembered, so they are
+    not created again before every upload.
+
+    The pool starts over when used in a forked process (workers).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._idle = {}
+        self._containers = set()
+        self.hits = 0
+        self.misses = 0
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            self._reset()
+
+    def clear(self):
+        with self._lock:
+            self._reset()
+
+    @contextmanager
+    def connection(self, key, factory):
+        """Yield an idle connection of the key or a new one from factory"""
+        conn = None
+        with self._lock:
+            self._check_pid()
+            idle = self._idle.get(key)
+            if idle:
+                self.hits += 1
+                conn = idle.pop()
+            else:
+                self.misses += 1
+        if conn is None:
+            conn = factory()
+        try:
+            yield conn
+        finally:
+            self._release(key, conn)
+
+    def _release(self, key, conn):
+        max_idle = int(os.environ.get('SWIFT_POOL_SIZE') or 10)
+        with self._lock:
+            self._check_pid()
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < max_idle:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def is_container_known(self, key, container):
+        with self._lock:
+            self._check_pid()
+            return (key, container) in self._containers
+
+    def add_container(self, key, container):
+        with self._lock:
+            self._check_pid()
+            self._containers.add((key, container))
+
+    def discard_container(self, key, container):
+        with self._lock:
+            self._check_pid()
+            self._containers.discard((key, container))
+
+    def stats(self):
+        with self._lock:
+            self._check_pid()
+            return {
+                'pool_hits': self.hits,
+                'pool_misses': self.misses,
+                'idle_connections': sum(
+                    len(idle) for idle in self._idle.values()
+                ),
+                'containers': len(self._containers),
+            }
+
+
+swift_connection_pool = SwiftConnectionPool()
+
+
 class IrAttachment(models.Model):
     _inherit = 'ir.attachment'
 
@@ -80,6 +195,43 @@ class IrAttachment(models.Model):
         l += super()._get_stores()
         return l
 
+    @api.model
+    def _object_storage_stats(self):
+        stats = super()._object_storage_stats()
+        stats['swift'] = swift_connection_pool.stats()
+        return stats
+
+    @api.model
+    def _get_swift_pool_key(self):
+        return tuple(
+            os.environ.get(name) for name in (
+                'SWIFT_AUTH_URL',
+                'SWIFT_ACCOUNT',
+                'SWIFT_PASSWORD',
+                'SWIFT_PROJECT_NAME',
+                'SWIFT_TENANT_NAME',
+                'SWIFT_REGION_NAME',
+            )
+        )
+
+    @contextmanager
+    def _swift_connection(self):
+        """Yield a connection of the pool, given back to the pool after use
+
+        Raise a UserError if the connection cannot be created.
+        """
+        with swift_connection_pool.connection(
+            self._get_swift_pool_key(), self._get_swift_connection
+        ) as conn:
+            yield conn
+
+    def _swift_put_container(self, conn, container):
+        """Create the container unless the process already did"""
+        key = self._get_swift_pool_key()
+        if not swift_connection_pool.is_container_known(key, container):
+            conn.put_container(container)
+            swift_connection_pool.add_container(key, container)
+
     @api.model
     def _get_swift_connection(self):
         """ Returns a connection object for the Swift object store """
@@ -124,41 +276,308 @@ class IrAttachment(models.Model):
         if fname.startswith('swift://'):
             swifturi = SwiftUri(fname)
             try:
-                conn = self._get_swift_connection()
+                with self._swift_connection() as conn:
+                    read = self._swift_get_object(
+                        conn, swifturi.container(), swifturi.item()
+                    )
             except exceptions.UserError:
                 _logger.exception(
                     "error reading attachment '%s' from object storage", fname
                 )
                 return ''
+            except ClientException as error:
+                read = ''
+                if error.http_status == 404:
+                    self._store_file_missing(fname)
+                else:
+                    _logger.exception(
+                        'Error reading object from Swift object store')
+            return read
+        else:
+            return super()._store_file_read(fname)
+
+    def _swift_get_object(self, conn, container, item):
+        """Download an object, large objects are downloaded by parts
+
+        The first ``SWIFT_DOWNLOAD_PART_SIZE`` bytes (default 32 MiB) are
+        read with a range request, which gives the size of the object. The
+        remaining parts are read concurrently, ``SWIFT_DOWNLOAD_CONCURRENCY``
+        at a time (default 4), in a buffer of the size of the object.
+        """
+        part_size = int(
+            os.environ.get('SWIFT_DOWNLOAD_PART_SIZE') or 32 * 1024 * 1024
+        )
+        try:
+            headers, first = conn.get_object(
+                container, item,
+                headers={'Range': 'bytes=0-{}'.format(part_size - 1)},
+            )
+        except ClientException as error:
+            if error.http_status != 416:
+                raise
+            # empty object
+            __, read = conn.get_object(container, item)
+            return read
+        # e.g. 'bytes 0-33554431/104857600', missing if the range has been
+        # ignored and the whole object returned
+        content_range = headers.get('content-range') or ''
+        size = int(content_range.rpartition('/')[2] or 0)
+        if size <= len(first):
+            return first
+        buf = bytearray(size)
+        view = memoryview(buf)
+        view[:len(first)] = first
+
+        def get_part(offset):
+            end = min(offset + part_size, size) - 1
+            # connections are not thread-safe
+            with self._swift_connection() as part_conn:
+                __, part = part_conn.get_object(
+                    container, item,
+                    headers={'Range': 'bytes={}-{}'.format(offset, end)},
+                )
+            view[offset:offset + len(part)] = part
+
+        concurrency = int(os.environ.get('SWIFT_DOWNLOAD_CONCURRENCY') or 4)
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            # raise the errors of the parts
+            list(executor.map(get_part, range(len(first), size, part_size)))
+        return bytes(buf)
+
+    @api.model
+    def _store_file_read_iter(self, fname, start=0, chunk_size=None):
+        if fname.startswith('swift://'):
+            swifturi = SwiftUri(fname)
+            headers = {}
+            if start:
+                headers['Range'] = 'bytes={}-'.format(start)
+            # the connection is given back to the pool once the body has
+            # been consumed or closed
+            stack = ExitStack()
             try:
-                resp, read = conn.get_object(
+                conn = stack.enter_context(self._swift_connection())
+                __, body = conn.get_object(
                     swifturi.container(),
-                    swifturi.item()
+                    swifturi.item(),
+                    resp_chunk_size=chunk_size or 1024 * 1024,
+                    headers=headers,
                 )
-            except ClientException:
-                read = ''
+            except (exceptions.UserError, ClientException) as error:
+                stack.close()
+                if getattr(error, 'http_status', None) == 404:
+                    self._store_file_missing(fname)
+                else:
+                    _logger.exception(
+                        "error reading attachment '%s' from object storage",
+                        fname,
+                    )
+                return iter(())
+            return ClosingIterator(body, stack)
+        else:
+            return super()._store_file_read_iter(
+                fname, start=start, chunk_size=chunk_size
+            )
+
+    @api.model
+    def _store_file_redirect_url(self, fname, download_name=None,
+                                 mimetype=None, as_attachment=False):
+        if fname.startswith('swift://'):
+            # requires the tempurl middleware, with the key set on the
+            # account (X-Account-Meta-Temp-URL-Key)
+            temp_url_key = os.environ.get('SWIFT_TEMP_URL_KEY')
+            if not temp_url_key:
+                return None
+            swifturi = SwiftUri(fname)
+            try:
+                with self._swift_connection() as conn:
+                    storage_url, __ = conn.get_auth()
+            except (exceptions.UserError, ClientException):
                 _logger.exception(
-                    'Error reading object from Swift object store')
-            return read
+                    "error generating a temporary url for '%s'", fname
+                )
+                return None
+            url = urlsplit(storage_url)
+            path = '{}/{}/{}'.format(
+                url.path, swifturi.container(), swifturi.item()
+            )
+            temp_path = swiftclient.utils.generate_temp_url(
+                path, redirect_expiry(), temp_url_key, 'GET'
+            )
+            __, __, query = temp_path.partition('?')
+            if download_name:
+                query += '&filename={}'.format(quote(download_name))
+            if not as_attachment:
+                query += '&inline'
+            return '{}://{}{}?{}'.format(
+                url.scheme, url.netloc, quote(path), query
+            )
         else:
-            return super()._store_file_read(fname)
+            return super()._store_file_redirect_url(
+                fname,
+                download_name=download_name,
+                mimetype=mimetype,
+                as_attachment=as_attachment,
+            )
 
-    def _store_file_write(self, key, bin_data):
-        if self._storage() == 'swift':
+    @api.model
+    def _store_file_name(self, key):
+        location = self.env.context.get('storage_location') or self._storage()
+        if location == 'swift':
             container = os.environ.get('SWIFT_WRITE_CONTAINER')
-            conn = self._get_swift_connection()
-            conn.put_container(container)
-            filename = 'swift://{}/{}'.format(container, key)
+            return container and 'swift://{}/{}'.format(container, key)
+        return super()._store_file_name(key)
+
+    @api.model
+    def _store_file_exists(self, fname):
+        if fname.startswith('swift://'):
+            swifturi = SwiftUri(fname)
             try:
-                conn.put_object(container, key, bin_data)
-            except ClientException:
-                _logger.exception('Error writing to Swift object store')
-                raise exceptions.UserError(_('Error writing to Swift'))
+                with self._swift_connection() as conn:
+                    conn.head_object(swifturi.container(), swifturi.item())
+            except (ClientException, exceptions.UserError):
+                return False
+            return True
+        return super()._store_file_exists(fname)
+
+    @api.model
+    def _store_file_copy(self, fname, key):
+        if fname.startswith('swift://'):
+            swifturi = SwiftUri(fname)
+            container = os.environ.get('SWIFT_WRITE_CONTAINER')
+            with self._swift_connection() as conn:
+                self._swift_put_container(conn, container)
+                # the copy of a large object is a regular object, the copy
+                # is limited to the maximum size of an object (5 GiB)
+                conn.copy_object(
+                    swifturi.container(),
+                    swifturi.item(),
+                    destination='/{}/{}'.format(container, key),
+                )
+            return 'swift://{}/{}'.format(container, key)
+        return super()._store_file_copy(fname, key)
+
+    def _store_file_write(self, key, bin_data):
+        location = self.env.context.get('storage_location') or self._storage()
+        if location == 'swift':
+            filename = self._swift_write(key, bin_data, len(bin_data))
         else:
             _super = super()
             filename = _super._store_file_write(key, bin_data)
         return filename
 
+    def _store_file_write_fileobj(self, key, fileobj, size):
+        location = self.env.context.get('storage_location') or self._storage()
+        if location == 'swift':
+            filename = self._swift_write(key, fileobj, size)
+        else:
+            _super = super()
+            filename = _super._store_file_write_fileobj(key, fileobj, size)
+        return filename
+
+    def _swift_write(self, key, contents, size):
+        container = os.environ.get('SWIFT_WRITE_CONTAINER')
+        with self._swift_connection() as conn:
+            try:
+                self._swift_put_container(conn, container)
+                self._swift_put_object(conn, container, key, contents, size)
+            except ClientException:
+                # the container may have been deleted in the meantime
+                swift_connection_pool.discard_container(
+                    self._get_swift_pool_key(), container
+                )
+                _logger.exception('Error writing to Swift object store')
+                raise exceptions.UserError(_('Error writing to Swift'))
+        return 'swift://{}/{}'.format(container, key)
+
+    def _swift_put_object(self, conn, container, key, contents, size):
+        """Upload an object, large objects are uploaded by segments
+
+        ``contents`` is either bytes or a file object, read while it is
+        sent. Objects above ``SWIFT_SEGMENT_SIZE`` bytes (default 100 MiB)
+        are uploaded as Static Large Objects: the segments are read one
+        after the other and uploaded concurrently,
+        ``SWIFT_UPLOAD_CONCURRENCY`` at a time (default 4), in the container
+        ``<container>_segments``, then the manifest is uploaded with the key
+        of the object.
+        """
+        segment_size = int(
+            os.environ.get('SWIFT_SEGMENT_SIZE') or 100 * 1024 * 1024
+        )
+        if size <= segment_size:
+            if isinstance(contents, bytes):
+                conn.put_object(container, key, contents)
+            else:
+                conn.put_object(
+                    container, key, contents, content_length=size,
+                    chunk_size=SWIFT_PUT_CHUNK_SIZE,
+                )
+            return
+        if isinstance(contents, bytes):
+            contents = io.BytesIO(contents)
+        segments_container = swift_segments_container(container)
+        self._swift_put_container(conn, segments_container)
+
+        def put_segment(index, segment):
+            name = '{}/{:08d}'.format(key, index)
+            # connections are not thread-safe
+            with self._swift_connection() as segment_conn:
+                etag = segment_conn.put_object(
+                    segments_container, name, segment
+                )
+            return {
+                'path': '/{}/{}'.format(segments_container, name),
+                'etag': etag,
+                'size_bytes': len(segment),
+            }
+
+        count = -(-size // segment_size)
+        concurrency = int(os.environ.get('SWIFT_UPLOAD_CONCURRENCY') or 4)
+        futures = []
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for index in range(count):
+                # at most 'concurrency' segments are held in memory
+                running = [future for future in futures if not future.done()]
+                if len(running) >= concurrency:
+                    wait(running, return_when=FIRST_COMPLETED)
+                segment = contents.read(segment_size)
+                futures.append(executor.submit(put_segment, index, segment))
+            manifest = [future.result() for future in futures]
+        conn.put_object(
+            container, key, json.dumps(manifest),
+            query_string='multipart-manifest=put',
+        )
+
+    def _swift_delete_segments(self, conn, container, items):
+        """Delete the segments of the large objects among the items
+
+        The segments container is listed once for all the items, between
+        the first and the last of them: the segments of an item are named
+        ``<item>/<index>`` and sort right after it.
+        """
+        if not items:
+            return
+        segments_container = swift_segments_container(container)
+        items = set(items)
+        try:
+            __, objects = conn.get_container(
+                segments_container,
+                marker=min(items),
+                # '0' sorts right after '/'
+                end_marker=max(items) + '0',
+                full_listing=True,
+            )
+        except ClientException as error:
+            if error.http_status != 404:
+                _logger.exception('Error listing the Swift segments')
+            # no large object has ever been uploaded otherwise
+            return
+        segments = [
+            obj['name'] for obj in objects
+            if obj['name'].rpartition('/')[0] in items
+        ]
+        for chunk in split_every(SWIFT_BULK_DELETE_SIZE, segments):
+            self._swift_bulk_delete(conn, segments_container, chunk)
+
     @api.model
     def _store_file_delete(self, fname):
         if fname.startswith('swift://'):
@@ -167,13 +586,82 @@ class IrAttachment(models.Model):
             # delete the file only if it is on the current configured bucket
             # otherwise, we might delete files used on a different environment
             if container == os.environ.get('SWIFT_WRITE_CONTAINER'):
-                conn = self._get_swift_connection()
+                with self._swift_connection() as conn:
+                    try:
+                        # the segments of a large object are deleted with
+                        # its manifest, other objects are deleted as usual
+                        conn.delete_object(
+                            container, swifturi.item(),
+                            query_string='multipart-manifest=delete',
+                        )
+                    except ClientException:
+                        _logger.exception(
+                            _('Error deleting an object on the Swift store'))
+                        # we ignore the error, file will stay on the object
+                        # storage but won't disrupt the process
+        else:
+            super()._store_file_delete(fname)
+
+    @api.model
+    def _store_files_delete(self, fnames):
+        swift_fnames = [f for f in fnames if f.startswith('swift://')]
+        others = [f for f in fnames if not f.startswith('swift://')]
+        if swift_fnames:
+            container = os.environ.get('SWIFT_WRITE_CONTAINER')
+            # delete the files only if they are on the current configured
+            # container otherwise, we might delete files used on a different
+            # environment
+            items = []
+            for fname in swift_fnames:
+                swifturi = SwiftUri(fname)
+                if swifturi.container() == container:
+                    items.append(swifturi.item())
+            with self._swift_connection() as conn:
+                for chunk in split_every(SWIFT_BULK_DELETE_SIZE, items):
+                    self._swift_bulk_delete(conn, container, chunk)
+                # one listing for the whole batch, the bulk deletion does
+                # not delete the segments of the manifests
+                self._swift_delete_segments(conn, container, items)
+        if others:
+            super()._store_files_delete(others)
+
+    def _swift_bulk_delete(self, conn, container, items):
+        """Delete objects with the bulk-delete middleware of Swift
+
+        Fallback on one request per object if the middleware is not
+        available.
+        """
+        body = '\n'.join(
+            quote('/{}/{}'.format(container, item)) for item in items
+        )
+        try:
+            __, response = conn.post_account(
+                headers={
+                    'Accept': 'application/json',
+                    'Content-Type': 'text/plain',
+                },
+                query_string='bulk-delete',
+                data=body.encode('utf-8'),
+            )
+            result = json.loads(response or '{}')
+        except (ClientException, ValueError):
+            _logger.warning(
+                'Bulk deletion not available on the Swift store, deleting'
+                ' %d objects one by one', len(items), exc_info=True,
+            )
+            for item in items:
                 try:
-                    conn.delete_object(container, swifturi.item())
+                    conn.delete_object(container, item)
                 except ClientException:
                     _logger.exception(
-                        _('Error deleting an object on the Swift store'))
-                    # we ignore the error, file will stay on the object
-                    # storage but won't disrupt the process
-        else:
-            super()._file_delete_from_store(fname)
+                        'Error deleting an object on the Swift store')
+            return
+        for path, error in result.get('Errors') or []:
+            _logger.error(
+                'Error deleting object %s on the Swift store: %s',
+                path, error,
+            )
+        _logger.info(
+            '%s files deleted on the object storage',
+            result.get('Number Deleted', 0),
+        )
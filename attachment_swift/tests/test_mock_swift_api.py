@@ -2,6 +2,7 @@
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
 
 import base64
+import io
 import mock
 import os
 
@@ -10,7 +11,13 @@ from mock import patch
 import keystoneauth1
 
 from odoo.addons.base.tests.test_ir_attachment import TestIrAttachment
-from odoo.addons.attachment_swift.models.ir_attachment import SwiftSessionStore
+from odoo.addons.base_attachment_object_storage.models.ir_attachment import (
+    known_files,
+)
+from odoo.addons.attachment_swift.models.ir_attachment import (
+    SwiftSessionStore,
+    swift_connection_pool,
+)
 from odoo.addons.attachment_swift.swift_uri import SwiftUri
 
 
@@ -21,6 +28,15 @@ class TestAttachmentSwift(TestIrAttachment):
         self.env['ir.config_parameter'].set_param('ir_attachment.location',
                                                   'swift')
 
+    def setUp(self):
+        super().setUp()
+        # uploads of a content written by a previous test must not be skipped
+        known_files.clear()
+        self.addCleanup(known_files.clear)
+        # the pooled connections are the mocks of a previous test
+        swift_connection_pool.clear()
+        self.addCleanup(swift_connection_pool.clear)
+
     def test_session_store_get_session(self):
         auth_url = 'auth_url'
         username = 'username'
@@ -98,6 +114,148 @@ class TestAttachmentSwift(TestIrAttachment):
                 attachment._compute_checksum(bin_data),
                 bin_data)
 
+    def test_store_large_file_on_swift(self):
+        """
+            Test writing a file larger than a segment
+        """
+        (self.env['ir.config_parameter'].
+            set_param('ir_attachment.location', 'swift'))
+        os.environ['SWIFT_AUTH_URL'] = 'auth_url'
+        os.environ['SWIFT_ACCOUNT'] = 'account'
+        os.environ['SWIFT_PASSWORD'] = 'password'
+        os.environ['SWIFT_PROJECT_NAME'] = 'project_name'
+        os.environ['SWIFT_WRITE_CONTAINER'] = 'my_container'
+        container = os.environ.get('SWIFT_WRITE_CONTAINER')
+        attachment = self.Attachment
+        bin_data = base64.b64decode(self.blob1_b64)
+        key = attachment._compute_checksum(bin_data)
+        with patch.dict(os.environ, {'SWIFT_SEGMENT_SIZE': '4'}), \
+                patch('swiftclient.client.Connection') as MockConnection:
+            conn = MockConnection.return_value
+            conn.put_object.return_value = 'etag'
+            attachment.create({'name': 'a5', 'datas': self.blob1_b64})
+            segments = [
+                call for call in conn.put_object.call_args_list
+                if call[0][0] == container + '_segments'
+            ]
+            self.assertEqual(len(segments), -(-len(bin_data) // 4))
+            conn.put_object.assert_called_with(
+                container, key, mock.ANY,
+                query_string='multipart-manifest=put',
+            )
+
+    def test_store_file_from_file_object_on_swift(self):
+        """
+            Test a file object is streamed to the object storage
+        """
+        (self.env['ir.config_parameter'].
+            set_param('ir_attachment.location', 'swift'))
+        os.environ['SWIFT_AUTH_URL'] = 'auth_url'
+        os.environ['SWIFT_ACCOUNT'] = 'account'
+        os.environ['SWIFT_PASSWORD'] = 'password'
+        os.environ['SWIFT_PROJECT_NAME'] = 'project_name'
+        os.environ['SWIFT_WRITE_CONTAINER'] = 'my_container'
+        attachment = self.Attachment
+        bin_data = base64.b64decode(self.blob1_b64)
+        with patch('swiftclient.client.Connection') as MockConnection, \
+                io.BytesIO(bin_data) as file:
+            conn = MockConnection.return_value
+            fname = attachment._store_file_write_fileobj(
+                'key', file, len(bin_data)
+            )
+            conn.put_object.assert_called_with(
+                'my_container', 'key', file, content_length=len(bin_data),
+                chunk_size=mock.ANY,
+            )
+            self.assertEqual(fname, 'swift://my_container/key')
+
+    def test_store_file_with_key_layout_on_swift(self):
+        """
+            Test the key of a file follows the configured layout
+        """
+        (self.env['ir.config_parameter'].
+            set_param('ir_attachment.location', 'swift'))
+        os.environ['SWIFT_AUTH_URL'] = 'auth_url'
+        os.environ['SWIFT_ACCOUNT'] = 'account'
+        os.environ['SWIFT_PASSWORD'] = 'password'
+        os.environ['SWIFT_PROJECT_NAME'] = 'project_name'
+        os.environ['SWIFT_WRITE_CONTAINER'] = 'my_container'
+        attachment = self.Attachment
+        bin_data = base64.b64decode(self.blob1_b64)
+        sha = attachment._compute_checksum(bin_data)
+        layout = '{db}/{sha[:2]}/{sha[2:4]}/{sha}'
+        with patch.dict(os.environ, {'ODOO_ATTACHMENT_KEY_LAYOUT': layout}), \
+                patch('swiftclient.client.Connection') as MockConnection:
+            conn = MockConnection.return_value
+            a5 = attachment.create({'name': 'a5', 'datas': self.blob1_b64})
+            key = '{}/{}/{}/{}'.format(
+                self.env.cr.dbname, sha[:2], sha[2:4], sha
+            )
+            conn.put_object.assert_called_with('my_container', key, bin_data)
+            self.assertEqual(a5.store_fname, 'swift://my_container/' + key)
+
+    def test_skip_upload_of_known_file_on_swift(self):
+        """
+            Test writing twice the same content uploads it once
+        """
+        (self.env['ir.config_parameter'].
+            set_param('ir_attachment.location', 'swift'))
+        os.environ['SWIFT_AUTH_URL'] = 'auth_url'
+        os.environ['SWIFT_ACCOUNT'] = 'account'
+        os.environ['SWIFT_PASSWORD'] = 'password'
+        os.environ['SWIFT_PROJECT_NAME'] = 'project_name'
+        os.environ['SWIFT_WRITE_CONTAINER'] = 'my_container'
+        attachment = self.Attachment
+        with patch('swiftclient.client.Connection') as MockConnection:
+            conn = MockConnection.return_value
+            a5 = attachment.create({'name': 'a5', 'datas': self.blob1_b64})
+            a6 = attachment.create({'name': 'a6', 'datas': self.blob1_b64})
+            self.assertEqual(a5.store_fname, a6.store_fname)
+            self.assertEqual(conn.put_object.call_count, 1)
+
+    def test_reuse_connection_and_container_on_swift(self):
+        """
+            Test writing twice uses one connection and creates the container
+            once
+        """
+        (self.env['ir.config_parameter'].
+            set_param('ir_attachment.location', 'swift'))
+        os.environ['SWIFT_AUTH_URL'] = 'auth_url'
+        os.environ['SWIFT_ACCOUNT'] = 'account'
+        os.environ['SWIFT_PASSWORD'] = 'password'
+        os.environ['SWIFT_PROJECT_NAME'] = 'project_name'
+        os.environ['SWIFT_WRITE_CONTAINER'] = 'my_container'
+        attachment = self.Attachment
+        with patch('swiftclient.client.Connection') as MockConnection:
+            conn = MockConnection.return_value
+            attachment.create({'name': 'a5', 'datas': self.blob1_b64})
+            attachment.create({'name': 'a6', 'datas': self.blob2_b64})
+            MockConnection.assert_called_once()
+            conn.put_container.assert_called_once_with('my_container')
+            self.assertEqual(conn.put_object.call_count, 2)
+
+    def test_read_size_without_reading_file_on_swift(self):
+        """
+            Test reading the fields of a form view does not download the file
+        """
+        (self.env['ir.config_parameter'].
+            set_param('ir_attachment.location', 'swift'))
+        os.environ['SWIFT_AUTH_URL'] = 'auth_url'
+        os.environ['SWIFT_ACCOUNT'] = 'account'
+        os.environ['SWIFT_PASSWORD'] = 'password'
+        os.environ['SWIFT_PROJECT_NAME'] = 'project_name'
+        os.environ['SWIFT_WRITE_CONTAINER'] = 'my_container'
+        attachment = self.Attachment
+        with patch('swiftclient.client.Connection') as MockConnection:
+            conn = MockConnection.return_value
+            a5 = attachment.create({'name': 'a5', 'datas': self.blob1_b64})
+            a5.invalidate_recordset()
+            values = a5.with_context(bin_size=True).read()[0]
+            conn.get_object.assert_not_called()
+            self.assertEqual(values['file_size'], len(self.blob1))
+            self.assertTrue(values['datas'])
+            self.assertTrue(values['raw'])
+
     def test_delete_file_on_swift(self):
         """
             Test deleting a file
@@ -114,7 +272,103 @@ class TestAttachmentSwift(TestIrAttachment):
         container = os.environ.get('SWIFT_WRITE_CONTAINER')
         with patch('swiftclient.client.Connection') as MockConnection:
             conn = MockConnection.return_value
+            conn.post_account.return_value = (
+                {}, b'{"Number Deleted": 1, "Errors": []}'
+            )
+            conn.get_container.return_value = ({}, [])
             a5 = attachment.create({'name': 'a5', 'datas': self.blob1_b64})
             uri = SwiftUri(a5.store_fname)
             a5.unlink()
-            conn.delete_object.assert_called_with(container, uri.item())
+            # the deletion is deferred to the garbage collector
+            conn.post_account.assert_not_called()
+            conn.delete_object.assert_not_called()
+            __, to_delete = attachment._object_storage_gc_batch(1000, 0)
+            # deleted once the batch is committed
+            attachment._store_files_delete(to_delete)
+            conn.post_account.assert_called_once_with(
+                headers=mock.ANY,
+                query_string='bulk-delete',
+                data='/{}/{}'.format(container, uri.item()).encode('utf-8'),
+            )
+
+    def test_gc_keeps_used_file_on_swift(self):
+        """
+            Test a file still used by another attachment is not deleted
+        """
+        (self.env['ir.config_parameter'].
+            set_param('ir_attachment.location', 'swift'))
+        os.environ['SWIFT_AUTH_URL'] = 'auth_url'
+        os.environ['SWIFT_ACCOUNT'] = 'account'
+        os.environ['SWIFT_PASSWORD'] = 'password'
+        os.environ['SWIFT_PROJECT_NAME'] = 'project_name'
+        os.environ['SWIFT_WRITE_CONTAINER'] = 'my_container'
+
+        attachment = self.Attachment
+        with patch('swiftclient.client.Connection') as MockConnection:
+            conn = MockConnection.return_value
+            a5 = attachment.create({'name': 'a5', 'datas': self.blob1_b64})
+            a6 = attachment.create({'name': 'a6', 'datas': self.blob1_b64})
+            self.assertEqual(a5.store_fname, a6.store_fname)
+            a5.unlink()
+            __, to_delete = attachment._object_storage_gc_batch(1000, 0)
+            self.assertEqual(to_delete, [])
+            conn.post_account.assert_not_called()
+            conn.delete_object.assert_not_called()
+
+    def test_delete_segments_once_per_batch(self):
+        """
+            Test the segments container is listed once for a batch
+        """
+        os.environ['SWIFT_AUTH_URL'] = 'auth_url'
+        os.environ['SWIFT_ACCOUNT'] = 'account'
+        os.environ['SWIFT_PASSWORD'] = 'password'
+        os.environ['SWIFT_PROJECT_NAME'] = 'project_name'
+        os.environ['SWIFT_WRITE_CONTAINER'] = 'my_container'
+        container = os.environ.get('SWIFT_WRITE_CONTAINER')
+        with patch('swiftclient.client.Connection') as MockConnection:
+            conn = MockConnection.return_value
+            conn.post_account.return_value = (
+                {}, b'{"Number Deleted": 1, "Errors": []}'
+            )
+            conn.get_container.return_value = ({}, [
+                {'name': 'aaaa/00000000'},
+                {'name': 'aaaa/00000001'},
+                {'name': 'bbbb/00000000'},
+            ])
+            self.Attachment._store_files_delete([
+                'swift://{}/aaaa'.format(container),
+                'swift://{}/cccc'.format(container),
+            ])
+            conn.get_container.assert_called_once_with(
+                container + '_segments',
+                marker='aaaa',
+                end_marker='cccc0',
+                full_listing=True,
+            )
+            conn.post_account.assert_called_with(
+                headers=mock.ANY,
+                query_string='bulk-delete',
+                data='/{0}_segments/aaaa/00000000\n'
+                     '/{0}_segments/aaaa/00000001'.format(
+                         container).encode('utf-8'),
+            )
+
+    def test_delete_large_file_with_its_manifest(self):
+        """
+            Test a single deletion deletes the segments with the manifest
+        """
+        os.environ['SWIFT_AUTH_URL'] = 'auth_url'
+        os.environ['SWIFT_ACCOUNT'] = 'account'
+        os.environ['SWIFT_PASSWORD'] = 'password'
+        os.environ['SWIFT_PROJECT_NAME'] = 'project_name'
+        os.environ['SWIFT_WRITE_CONTAINER'] = 'my_container'
+        container = os.environ.get('SWIFT_WRITE_CONTAINER')
+        with patch('swiftclient.client.Connection') as MockConnection:
+            conn = MockConnection.return_value
+            self.Attachment._store_file_delete(
+                'swift://{}/aaaa'.format(container)
+            )
+            conn.delete_object.assert_called_once_with(
+                container, 'aaaa', query_string='multipart-manifest=delete',
+            )
+            conn.get_container.assert_not_called()
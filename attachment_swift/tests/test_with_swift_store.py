@@ -38,5 +38,7 @@ class TestAttachmentSwift(TestIrAttachment):
         con = self.Attachment._get_swift_connection()
         con.get_object(uri.container(), uri.item())
         a5.unlink()
+        __, to_delete = self.Attachment._object_storage_gc_batch(1000, 0)
+        self.Attachment._store_files_delete(to_delete)
         with self.assertRaises(ClientException):
             con.get_object(uri.container(), uri.item())
@@ -5,13 +5,17 @@
 {
     "name": "Base Attachment Object Store",
     "summary": "Base module for the implementation of external object store.",
-    "version": "16.0.1.0.0",
+    "version": "16.0.1.4.0",
     "author": "Camptocamp,Odoo Community Association (OCA)",
     "license": "AGPL-3",
     "category": "Knowledge Management",
     "depends": ["base"],
     "website": "http://www.camptocamp.com",
-    "data": ["data/res_config_settings_data.xml"],
+    "data": [
+        "security/ir.model.access.csv",
+        "data/res_config_settings_data.xml",
+        "data/ir_cron.xml",
+    ],
     "installable": True,
     "auto_install": True,
 }
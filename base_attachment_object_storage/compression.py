@@ -0,0 +1,110 @@
+# Copyright 2017-2019 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+import gzip
+import logging
+import threading
+import time
+import zlib
+
+_logger = logging.getLogger(__name__)
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+    _logger.debug("Cannot 'import zstandard'.")
+
+# suffix of the keys of the compressed files, it records the codec used,
+# '~' does not appear in the checksums nor in common file names
+CODEC_SUFFIXES = {"gzip": "~gzip", "zstd": "~zstd"}
+
+
+def codec_of(fname):
+    """Return the codec of a compressed file or None"""
+    for codec, suffix in CODEC_SUFFIXES.items():
+        if fname.endswith(suffix):
+            return codec
+    return None
+
+
+def available_codec(codec):
+    """Return the codec if it can be used, fallback on gzip"""
+    if codec == "zstd" and zstandard is None:
+        _logger.warning("zstandard is not installed, gzip is used instead")
+        return "gzip"
+    if codec not in CODEC_SUFFIXES:
+        _logger.warning("unknown compression codec %s, gzip is used instead", codec)
+        return "gzip"
+    return codec
+
+
+def compress(codec, data, mimetype=None):
+    start = time.thread_time()
+    if codec == "zstd":
+        compressed = zstandard.ZstdCompressor().compress(data)
+    else:
+        # no timestamp, the same content gives the same file
+        compressed = gzip.compress(data, compresslevel=6, mtime=0)
+    compression_stats.add(
+        mimetype or "", len(data), len(compressed), time.thread_time() - start
+    )
+    return compressed
+
+
+def decompress(codec, data):
+    if not data:
+        return data
+    if codec == "zstd":
+        return zstandard.ZstdDecompressor().decompress(data)
+    return gzip.decompress(data)
+
+
+def iter_decompress(codec, chunks, start=0):
+    """Decompress an iterator of chunks, skip the first ``start`` bytes"""
+    if codec == "zstd":
+        decompressor = zstandard.ZstdDecompressor().decompressobj()
+    else:
+        decompressor = zlib.decompressobj(wbits=31)
+    for chunk in chunks:
+        data = decompressor.decompress(chunk)
+        if start:
+            skipped = min(start, len(data))
+            data = data[skipped:]
+            start -= skipped
+        if data:
+            yield data
+    data = decompressor.flush()
+    if data[start:]:
+        yield data[start:]
+
+
+class CompressionStats(object):
+    """Ratio and CPU time of the compressions, by mimetype"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def add(self, mimetype, size, compressed_size, cpu_time):
+        with self._lock:
+            stats = self._stats.setdefault(
+                mimetype, {"files": 0, "bytes": 0, "compressed_bytes": 0, "cpu_time": 0}
+            )
+            stats["files"] += 1
+            stats["bytes"] += size
+            stats["compressed_bytes"] += compressed_size
+            stats["cpu_time"] += cpu_time
+
+    def stats(self):
+        with self._lock:
+            result = {}
+            for mimetype, stats in self._stats.items():
+                result[mimetype] = dict(
+                    stats,
+                    ratio=stats["bytes"] / (stats["compressed_bytes"] or 1),
+                )
+            return result
+
+
+compression_stats = CompressionStats()
@@ -0,0 +1,199 @@
+# Copyright 2017-2019 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024  # 1 GiB
+# interval in seconds between 2 scans of the cache directory, the size of
+# the cache is shared by all the processes of the host
+SCAN_INTERVAL = 300
+# size ratio kept after an eviction, avoids evicting on every write
+EVICTION_TARGET = 0.9
+TMP_PREFIX = ".tmp-"
+
+
+class AttachmentDiskCache(object):
+    """Read-through cache of object storage files on the local disk
+
+    The keys of the object storages are checksums of the content, a
+    file never changes once written, so it can be kept locally as long
+    as we want without risk of staleness. The callers must not cache the
+    files with other keys.
+
+    The directory can be shared by all the workers of a host: files are
+    written in a temporary file then renamed, so a reader never sees a
+    partial file. The access time of a file is tracked by its mtime,
+    updated on each hit, and the least recently used files are evicted
+    when the size of the directory exceeds ``max_bytes``.
+    """
+
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._size = 0
+        self._scanned_at = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _get_path(self, fname):
+        digest = hashlib.sha1(fname.encode("utf-8")).hexdigest()
+        return os.path.join(self.path, digest[:2], digest)
+
+    def get(self, fname):
+        """Return the content of the file or None if not in the cache"""
+        path = self._get_path(fname)
+        try:
+            with open(path, "rb") as cached:
+                content = cached.read()
+        except (IOError, OSError):
+            with self._lock:
+                self.misses += 1
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            # evicted by another process in the meantime
+            pass
+        with self._lock:
+            self.hits += 1
+        return content
+
+    def open(self, fname):
+        """Return the cached file opened in binary mode or None"""
+        path = self._get_path(fname)
+        try:
+            cached = open(path, "rb")
+        except (IOError, OSError):
+            with self._lock:
+                self.misses += 1
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        with self._lock:
+            self.hits += 1
+        return cached
+
+    def put(self, fname, content):
+        if len(content) > self.max_bytes:
+            return
+        path = self._get_path(fname)
+        dirname = os.path.dirname(path)
+        tmp_path = None
+        try:
+            os.makedirs(dirname, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix=TMP_PREFIX)
+            with os.fdopen(fd, "wb") as tmp:
+                tmp.write(content)
+            os.replace(tmp_path, path)
+        except (IOError, OSError):
+            _logger.warning(
+                "could not write '%s' in the attachment cache", fname, exc_info=True
+            )
+            if tmp_path and os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            return
+        self._added(len(content))
+
+    def _added(self, size):
+        with self._lock:
+            if time.time() - self._scanned_at > SCAN_INTERVAL:
+                # other processes write in the directory as well
+                self._size = sum(entry[2] for entry in self._scan())
+            else:
+                self._size += size
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _scan(self):
+        """Return (mtime, path, size) of every file of the cache"""
+        self._scanned_at = time.time()
+        entries = []
+        try:
+            subdirs = list(os.scandir(self.path))
+        except OSError:
+            return entries
+        for subdir in subdirs:
+            if not subdir.is_dir():
+                continue
+            try:
+                files = list(os.scandir(subdir.path))
+            except OSError:
+                continue
+            for entry in files:
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                if entry.name.startswith(TMP_PREFIX):
+                    # leftover of a killed process
+                    if stat.st_mtime < self._scanned_at - SCAN_INTERVAL:
+                        self._unlink(entry.path)
+                    continue
+                entries.append((stat.st_mtime, entry.path, stat.st_size))
+        return entries
+
+    def _unlink(self, path):
+        try:
+            os.unlink(path)
+        except OSError:
+            # already evicted by another process
+            return False
+        return True
+
+    def _evict(self):
+        entries = sorted(self._scan())
+        size = sum(entry[2] for entry in entries)
+        target = self.max_bytes * EVICTION_TARGET
+        for __, path, file_size in entries:
+            if size <= target:
+                break
+            if self._unlink(path):
+                self.evictions += 1
+            size -= file_size
+        self._size = size
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "bytes": self._size,
+                "max_bytes": self.max_bytes,
+            }
+
+
+_disk_cache = None
+_disk_cache_lock = threading.Lock()
+
+
+def get_disk_cache():
+    """Return the cache configured by the environment or None
+
+    * ``ODOO_ATTACHMENT_CACHE_DIR``: directory of the cache, the cache
+      is disabled when not set
+    * ``ODOO_ATTACHMENT_CACHE_MAX_BYTES``: maximum size of the cache
+      (default 1 GiB)
+    """
+    global _disk_cache
+    path = os.environ.get("ODOO_ATTACHMENT_CACHE_DIR")
+    if not path:
+        return None
+    with _disk_cache_lock:
+        if _disk_cache is None or _disk_cache.path != path:
+            max_bytes = int(
+                os.environ.get("ODOO_ATTACHMENT_CACHE_MAX_BYTES") or DEFAULT_MAX_BYTES
+            )
+            _disk_cache = AttachmentDiskCache(path, max_bytes=max_bytes)
+        return _disk_cache
@@ -0,0 +1,159 @@
+# Copyright 2017-2019 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+import logging
+import threading
+import time
+from collections import Counter, OrderedDict
+
+_logger = logging.getLogger(__name__)
+
+
+class KnownFilesCache(object):
+    """Files known to exist on the object storages
+
+    The keys of the files are the checksums of their content: when a
+    file known to exist is written again, the upload can be skipped.
+
+    The entries expire after ``ttl`` seconds, which must be shorter than
+    the delay of the garbage collector, so a file deleted by the
+    garbage collector of another process is not considered as existing.
+    The cache keeps at most ``max_size`` entries, the least recently
+    used ones are dropped first.
+    """
+
+    def __init__(self, max_size=100000, ttl=600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._files = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.remote_hits = 0
+        self.misses = 0
+
+    def __contains__(self, fname):
+        with self._lock:
+            expire_at = self._files.get(fname)
+            if expire_at is None or expire_at < time.time():
+                self._files.pop(fname, None)
+                return False
+            self._files.move_to_end(fname)
+            return True
+
+    def add(self, fname):
+        with self._lock:
+            self._files[fname] = time.time() + self.ttl
+            self._files.move_to_end(fname)
+            while len(self._files) > self.max_size:
+                self._files.popitem(last=False)
+
+    def discard(self, fnames):
+        with self._lock:
+            for fname in fnames:
+                self._files.pop(fname, None)
+
+    def clear(self):
+        with self._lock:
+            self._files.clear()
+
+    def count(self, hit=False, remote_hit=False):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            elif remote_hit:
+                self.remote_hits += 1
+            else:
+                self.misses += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "dedup_hits": self.hits,
+                "dedup_remote_hits": self.remote_hits,
+                "uploads": self.misses,
+                "known_files": len(self._files),
+            }
+
+
+class MissingFilesCache(object):
+    """Files known to be missing on the object storages
+
+    Reading a missing file costs a request to the object storage every
+    time, for nothing. The missing files are remembered for ``ttl``
+    seconds, at most ``max_size`` of them.
+
+    The number of reads of each missing file is counted, and reported
+    in the logs every ``report_interval`` seconds, so they can be
+    repaired.
+    """
+
+    def __init__(self, max_size=10000, ttl=60, report_interval=3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.report_interval = report_interval
+        self._files = OrderedDict()
+        self._reads = Counter()
+        self._reported_at = time.time()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, fname):
+        """Return whether the file is known to be missing, count the read"""
+        with self._lock:
+            expire_at = self._files.get(fname)
+            if expire_at is None or expire_at < time.time():
+                self._files.pop(fname, None)
+                return False
+            self.hits += 1
+            self._reads[fname] += 1
+        self._report()
+        return True
+
+    def add(self, fname):
+        with self._lock:
+            self.misses += 1
+            self._reads[fname] += 1
+            self._files[fname] = time.time() + self.ttl
+            self._files.move_to_end(fname)
+            while len(self._files) > self.max_size:
+                self._files.popitem(last=False)
+        self._report()
+
+    def discard(self, fnames):
+        with self._lock:
+            for fname in fnames:
+                self._files.pop(fname, None)
+
+    def clear(self):
+        with self._lock:
+            self._files.clear()
+            self._reads.clear()
+
+    def _report(self):
+        with self._lock:
+            if time.time() - self._reported_at < self.report_interval:
+                return
+            self._reported_at = time.time()
+            reads = self._reads
+            self._reads = Counter()
+        if reads:
+            _logger.warning(
+                "%d files missing on the object storage were read %d times"
+                " in the last %ds, most read: %s",
+                len(reads),
+                sum(reads.values()),
+                self.report_interval,
+                ", ".join(
+                    "%s (%d)" % (fname, count)
+                    for fname, count in reads.most_common(20)
+                ),
+            )
+
+    def stats(self):
+        with self._lock:
+            return {
+                "missing_hits": self.hits,
+                "missing_reads": self.misses,
+                "missing_files": len(self._files),
+            }
@@ -1 +1,4 @@
 from . import ir_attachment
+from . import object_storage_migration
+from . import object_storage_gc
+from . import ir_binary
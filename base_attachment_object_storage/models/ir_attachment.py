@@ -1,18 +1,30 @@
 # Copyright 2017-2019 Camptocamp SA
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
 
+import hashlib
 import inspect
+import io
 import logging
 import os
+import re
+import threading
 import time
+import uuid
 from .strtobool import strtobool
+from .. import compression
+from ..disk_cache import get_disk_cache
+from ..known_files import KnownFilesCache, MissingFilesCache
+from ..routing import ROUTE_DB, ROUTE_FILE, StorageRoutingPolicy, StorageRule
+from ..transaction_cache import TransactionFilesCache
 
-import psycopg2
 import odoo
+import psycopg2
 
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from contextlib import closing, contextmanager
-from odoo import api, exceptions, models, _
-from odoo.osv.expression import AND, OR, normalize_domain
+from odoo import api, exceptions, models, tools, _
+from odoo.osv.expression import AND, normalize_domain
+from odoo.tools import human_size, split_every
 from odoo.tools.safe_eval import const_eval
 
 
@@ -23,6 +35,198 @@ def is_true(strval):
     return bool(strtobool(strval or "0"))
 
 
+def env_int(name, default):
+    return int(os.environ.get(name) or default)
+
+
+known_files = KnownFilesCache(
+    max_size=env_int("ODOO_ATTACHMENT_DEDUP_CACHE_SIZE", 100000),
+    ttl=env_int("ODOO_ATTACHMENT_DEDUP_TTL", 600),
+)
+missing_files = MissingFilesCache(
+    ttl=env_int("ODOO_ATTACHMENT_MISSING_TTL", 60),
+    report_interval=env_int("ODOO_ATTACHMENT_MISSING_REPORT_INTERVAL", 3600),
+)
+
+
+class MigrationProgress(object):
+    """Count the attachments moved by a migration and log the throughput"""
+
+    def __init__(self, name, total):
+        self.name = name
+        self.total = total
+        self.done = 0
+        self.failed = 0
+        # attachments locked by other transactions, left to the next pass
+        self.skipped = 0
+        self.bytes = 0
+        self.start_time = time.time()
+        self._lock = threading.Lock()
+
+    def add_done(self, size=0):
+        with self._lock:
+            self.done += 1
+            self.bytes += size or 0
+
+    def add_failed(self, count=1):
+        with self._lock:
+            self.failed += count
+
+    def add_skipped(self, count=1):
+        with self._lock:
+            self.skipped += count
+
+    def eta(self):
+        """Return the estimated seconds until the end, None if unknown"""
+        processed = self.done + self.failed + self.skipped
+        if not processed or processed >= self.total:
+            return None
+        elapsed = time.time() - self.start_time
+        return elapsed / processed * (self.total - processed)
+
+    def log(self, final=False):
+        elapsed = max(time.time() - self.start_time, 0.001)
+        processed = self.done + self.failed + self.skipped
+        eta = None if final else self.eta()
+        _logger.info(
+            "%s: %s/%s attachments%s (%s failed, %s skipped) after %.2fs,"
+            " %.1f files/s, %.2f MB/s%s",
+            self.name,
+            processed,
+            self.total,
+            " done" if final else "",
+            self.failed,
+            self.skipped,
+            elapsed,
+            self.done / elapsed,
+            self.bytes / elapsed / 1024 / 1024,
+            ", about %.0fs left" % eta if eta is not None else "",
+        )
+
+
+class ChecksumReader(io.RawIOBase):
+    """Readable file-like object over an iterator of bytes
+
+    The sha1 and the size of the bytes read are computed on the way, to
+    check the content of a file while it is streamed to another store.
+    """
+
+    def __init__(self, chunks):
+        super().__init__()
+        self._chunks = iter(chunks)
+        self._buffer = memoryview(b"")
+        self.sha = hashlib.sha1()
+        self.size = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._buffer:
+            try:
+                self._buffer = memoryview(next(self._chunks))
+            except StopIteration:
+                return 0
+        size = min(len(buffer), len(self._buffer))
+        buffer[:size] = self._buffer[:size]
+        self.sha.update(self._buffer[:size])
+        self._buffer = self._buffer[size:]
+        self.size += size
+        return size
+
+    def close(self):
+        if hasattr(self._chunks, "close"):
+            self._chunks.close()
+        super().close()
+
+
+class ClosingIterator(object):
+    """Iterate over ``iterator``, close ``resources`` along with it
+
+    Closing a generator that has not started does not run its ``finally``
+    clauses, the connection or the file it reads from would stay open
+    until garbage collected. The resources are closed when the iterator
+    is exhausted or closed, whether the iteration started or not.
+    """
+
+    def __init__(self, iterator, *resources):
+        self._iterator = iter(iterator)
+        self._resources = resources
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self._iterator)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        resources, self._resources = self._resources, ()
+        if hasattr(self._iterator, "close"):
+            self._iterator.close()
+        for resource in resources:
+            resource.close()
+
+
+# end of the filenames whose key is the checksum of the content, with the
+# suffix of the codec of compressed files
+CONTENT_KEY = re.compile(r"[0-9a-f]{40}(?:~[a-z0-9]+)?$")
+
+
+def is_content_key(fname):
+    """Return whether the content of a file can never change
+
+    The files written with ``force_storage_key`` can be overwritten, they
+    must not be kept in the caches.
+    """
+    return bool(CONTENT_KEY.search(fname))
+
+
+# placeholders of ODOO_ATTACHMENT_KEY_LAYOUT: {db}, {sha} or a slice of
+# them like {sha[:2]}
+KEY_LAYOUT_PLACEHOLDER = re.compile(r"\{(db|sha)(?:\[(-?\d*):(-?\d*)\])?\}")
+
+
+def format_key(layout, db, sha):
+    values = {"db": db, "sha": sha}
+
+    def replace(match):
+        name, start, end = match.groups()
+        value = values[name]
+        if start is None:
+            return value
+        return value[int(start) if start else None : int(end) if end else None]
+
+    return KEY_LAYOUT_PLACEHOLDER.sub(replace, layout)
+
+
+def redirect_expiry():
+    return env_int("ODOO_ATTACHMENT_REDIRECT_EXPIRY", 300)
+
+
+def stream_chunk_size():
+    return env_int("ODOO_ATTACHMENT_STREAM_CHUNK_SIZE", 1024 * 1024)
+
+
+def iter_bytes(content, start, chunk_size):
+    view = memoryview(content)
+    for offset in range(start, len(view), chunk_size):
+        yield bytes(view[offset : offset + chunk_size])
+
+
+def iter_file(fileobj, start, chunk_size):
+    with fileobj:
+        fileobj.seek(start)
+        while True:
+            chunk = fileobj.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
 def clean_fs(files):
     _logger.info("cleaning old files from filestore")
     for full_path in files:
@@ -80,7 +284,18 @@ class IrAttachment(models.Model):
         # Typical example is images of ir.ui.menu which are updated in
         # ir.attachment at every upgrade of the addons
         if update_module:
-            self.env["ir.attachment"].sudo()._force_storage_to_object_storage()
+            # only the attachments written since the last complete migration
+            # need to be checked
+            self.env["ir.attachment"].sudo()._force_storage_to_object_storage(
+                incremental=True
+            )
+
+    def init(self):
+        super().init()
+        # used by the incremental migrations to the object storage
+        tools.create_index(
+            self._cr, "ir_attachment_write_date_index", self._table, ["write_date"]
+        )
 
     @property
     def _object_storage_default_force_db_config(self):
@@ -109,6 +324,174 @@ class IrAttachment(models.Model):
             storage_config = self._object_storage_default_force_db_config
         return storage_config
 
+    def _get_storage_routing_policy(self):
+        """Return the policy routing the attachments to the storages
+
+        The policy is compiled once from the system parameters and cached,
+        the cache is invalidated when the parameters change.
+        """
+        get_param = self.env["ir.config_parameter"].sudo().get_param
+        return self._compile_storage_routing_policy(
+            get_param("ir_attachment.storage.routing") or "",
+            get_param("ir_attachment.storage.force.database") or "",
+        )
+
+    @tools.ormcache("routing_param", "force_db_param")
+    def _compile_storage_routing_policy(self, routing_param, force_db_param):
+        """Build the routing policy from the system parameters
+
+        The rules of ``ir_attachment.storage.routing`` come first, as a list
+        of dictionaries, for instance::
+
+            [
+                {"res_model": "product.template", "route": "db"},
+                {"mimetype": "video/", "min_size": 10485760, "route": "file"},
+            ]
+
+        See ``StorageRule`` for the conditions of the rules. The
+        configuration of ``ir_attachment.storage.force.database`` is added
+        after them.
+        """
+        routes = {ROUTE_DB, ROUTE_FILE} | set(self._get_stores())
+        rules = []
+        if routing_param:
+            try:
+                for values in const_eval(routing_param):
+                    rule = StorageRule(**values)
+                    if rule.route not in routes:
+                        raise ValueError("Unknown route %s" % (rule.route,))
+                    rules.append(rule)
+            except (SyntaxError, TypeError, ValueError):
+                _logger.exception(
+                    "Could not parse system parameter"
+                    " 'ir_attachment.storage.routing', it is ignored."
+                )
+                rules = []
+        for mimetype_key, limit in self._get_storage_force_db_config().items():
+            rules.append(
+                StorageRule(ROUTE_DB, mimetype=mimetype_key, max_size=limit or None)
+            )
+        return StorageRoutingPolicy(rules)
+
+    def _object_storage_route(self, size, mimetype, res_model=None, res_field=None):
+        """Return where an attachment must be written instead of the store
+
+        Return ``db``, ``file``, the name of another object storage, or None
+        for the current object storage. The model and field of the
+        attachment are taken from the context when not given.
+        """
+        context = self.env.context
+        store = context.get("storage_location") or self._storage()
+        if res_model is None:
+            res_model = context.get("object_storage_res_model") or False
+        if res_field is None:
+            res_field = context.get("object_storage_res_field") or False
+        route = self._get_storage_routing_policy().route(
+            store, size, mimetype or "", res_model, res_field
+        )
+        return None if route == store else route
+
+    def _get_storage_redirect_config(self):
+        param = (
+            self.env["ir.config_parameter"]
+            .sudo()
+            .get_param(
+                "ir_attachment.storage.redirect",
+            )
+        )
+        redirect_config = {}
+        if param:
+            try:
+                redirect_config = const_eval(param)
+            except (SyntaxError, TypeError, ValueError):
+                _logger.exception(
+                    "Could not parse system parameter"
+                    " 'ir_attachment.storage.redirect', downloads are"
+                    " not redirected to the object storage."
+                )
+        return redirect_config or {}
+
+    def _get_storage_compress_config(self):
+        param = (
+            self.env["ir.config_parameter"]
+            .sudo()
+            .get_param(
+                "ir_attachment.storage.compress",
+            )
+        )
+        compress_config = {}
+        if param:
+            try:
+                compress_config = const_eval(param)
+            except (SyntaxError, TypeError, ValueError):
+                _logger.exception(
+                    "Could not parse system parameter"
+                    " 'ir_attachment.storage.compress', files are"
+                    " not compressed."
+                )
+        return compress_config or {}
+
+    def _object_storage_codec(self, size, mimetype):
+        """Return the codec used to compress a file or None
+
+        It is configured in the ir.config_parameter
+        ``ir_attachment.storage.compress``, as a dictionary, for instance::
+
+            {"text/": 4096, "application/xml": 4096, "application/json": 4096}
+
+        Where the key is the beginning of the mimetype to configure and the
+        value is the size from which the files are compressed. Nothing is
+        compressed when the parameter is not set. The codec is
+        ``ODOO_ATTACHMENT_COMPRESSION_CODEC``, ``gzip`` (default) or
+        ``zstd``.
+        """
+        mimetype = mimetype or ""
+        for mimetype_key, limit in self._get_storage_compress_config().items():
+            if mimetype.startswith(mimetype_key):
+                if size < (limit or 0):
+                    return None
+                return compression.available_codec(
+                    os.environ.get("ODOO_ATTACHMENT_COMPRESSION_CODEC") or "gzip"
+                )
+        return None
+
+    def _object_storage_redirect_allowed(self):
+        """Return whether the download can be redirected to the store
+
+        Instead of sending the content of the attachment through the Odoo
+        worker, the client can be redirected to a short-lived URL of the
+        object storage (presigned URL, SAS, TempURL).
+
+        It is configured in the ir.config_parameter
+        ``ir_attachment.storage.redirect``, as a dictionary, for instance::
+
+            {"video/": 0, "application/pdf": 1048576}
+
+        Where the key is the beginning of the mimetype to configure and the
+        value is the size from which the downloads are redirected. 0 means
+        any size. Nothing is redirected when the parameter is not set.
+        """
+        self.ensure_one()
+        if compression.codec_of(self.store_fname or ""):
+            # the object storage would send the compressed content
+            return False
+        mimetype = self.mimetype or ""
+        for mimetype_key, limit in self._get_storage_redirect_config().items():
+            if mimetype.startswith(mimetype_key):
+                return (self.file_size or 0) >= (limit or 0)
+        return False
+
+    def _store_file_redirect_url(
+        self, fname, download_name=None, mimetype=None, as_attachment=False
+    ):
+        """Return a short-lived URL to download a file from its store
+
+        The URL expires after ``ODOO_ATTACHMENT_REDIRECT_EXPIRY`` seconds
+        (default 300). Stores override this method, None is returned when
+        the store cannot generate such URL.
+        """
+        return None
+
     def _store_in_db_instead_of_object_storage_domain(self):
         """Return a domain for attachments that must be forced to DB
 
@@ -121,14 +504,8 @@ class IrAttachment(models.Model):
         The domain must be inline with the conditions in
         ``_store_in_db_instead_of_object_storage``.
         """
-        domain = []
-        storage_config = self._get_storage_force_db_config()
-        for mimetype_key, limit in storage_config.items():
-            part = [("mimetype", "=like", "{}%".format(mimetype_key))]
-            if limit:
-                part = AND([part, [("file_size", "<=", limit)]])
-            domain = OR([domain, part])
-        return domain
+        storage = self.env.context.get("storage_location") or self._storage()
+        return self._get_storage_routing_policy().domain(storage, ROUTE_DB)
 
     def _store_in_db_instead_of_object_storage(self, data, mimetype):
         """Return whether an attachment must be stored in db
@@ -152,7 +529,7 @@ class IrAttachment(models.Model):
 
         The configuration can be modified in the ir.config_parameter
         ``ir_attachment.storage.force.database``, as a dictionary, for
-        instance::
+        instance (see ``_compile_storage_routing_policy`` for finer rules)::
 
             {"image/": 51200, "application/javascript": 0, "text/css": 0}
 
@@ -173,19 +550,110 @@ class IrAttachment(models.Model):
         """
         if self.is_storage_disabled():
             return True
-        storage_config = self._get_storage_force_db_config()
-        for mimetype_key, limit in storage_config.items():
-            if mimetype.startswith(mimetype_key):
-                if not limit:
-                    return True
-                bin_data = data
-                return len(bin_data) <= limit
-        return False
+        return self._store_in_db_instead_of_object_storage_size(len(data), mimetype)
+
+    def _store_in_db_instead_of_object_storage_size(
+        self, size, mimetype, res_model=None, res_field=None
+    ):
+        """Same as ``_store_in_db_instead_of_object_storage`` using the size
+
+        Allows to take the decision without reading the content, for
+        instance from the ``file_size`` column.
+        """
+        route = self._object_storage_route(size, mimetype, res_model, res_field)
+        return route == ROUTE_DB
+
+    def _object_storage_write_behind(self, data):
+        """Return whether the upload of the data must be deferred
+
+        When ``ODOO_ATTACHMENT_WRITE_BEHIND`` is set, the content is staged
+        in the database and uploaded to the object storage by a cron after
+        the commit, so the user does not wait for the upload. Files above
+        ``ODOO_ATTACHMENT_WRITE_BEHIND_MAX_SIZE`` bytes (default 100 MiB) are
+        uploaded right away.
+        """
+        if not is_true(os.environ.get("ODOO_ATTACHMENT_WRITE_BEHIND")):
+            return False
+        if self.env.context.get("force_storage_key"):
+            # the staged content would be uploaded with its checksum as key
+            return False
+        max_size = env_int("ODOO_ATTACHMENT_WRITE_BEHIND_MAX_SIZE", 100 * 1024 * 1024)
+        return not max_size or len(data) <= max_size
+
+    def _object_storage_trigger_upload(self):
+        """Trigger the upload of the staged attachments after the commit"""
+        # once per transaction
+        data = self.env.cr.postcommit.data
+        if data.get("object_storage_upload_triggered"):
+            return
+        data["object_storage_upload_triggered"] = True
+        cron = self.env.ref(
+            "base_attachment_object_storage.ir_cron_object_storage_upload",
+            raise_if_not_found=False,
+        )
+        if cron:
+            cron.sudo()._trigger()
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        storage = self.env.context.get("storage_location") or self._storage()
+        if storage not in self._get_stores():
+            return super().create(vals_list)
+        # the files are routed according to the model and field of the
+        # attachments, create them by groups sharing them
+        groups = {}
+        for index, vals in enumerate(vals_list):
+            key = (vals.get("res_model") or False, vals.get("res_field") or False)
+            groups.setdefault(key, []).append(index)
+        ids = [None] * len(vals_list)
+        for (res_model, res_field), indexes in groups.items():
+            records = super(
+                IrAttachment,
+                self.with_context(
+                    object_storage_res_model=res_model,
+                    object_storage_res_field=res_field,
+                ),
+            ).create([vals_list[index] for index in indexes])
+            for index, record_id in zip(indexes, records.ids):
+                ids[index] = record_id
+        return self.browse(ids)
+
+    def _set_attachment_data(self, asbytes):
+        storage = self.env.context.get("storage_location") or self._storage()
+        if storage not in self._get_stores():
+            return super()._set_attachment_data(asbytes)
+        # see create()
+        for (res_model, res_field), attachments in tools.groupby(
+            self, key=lambda attach: (attach.res_model, attach.res_field)
+        ):
+            records = self.browse([attach.id for attach in attachments])
+            super(
+                IrAttachment,
+                records.with_context(
+                    object_storage_res_model=res_model,
+                    object_storage_res_field=res_field,
+                ),
+            )._set_attachment_data(asbytes)
 
     def _get_datas_related_values(self, data, mimetype):
         storage = self.env.context.get("storage_location") or self._storage()
         if data and storage in self._get_stores():
-            if self._store_in_db_instead_of_object_storage(data, mimetype):
+            route = self._object_storage_route(len(data), mimetype)
+            if route and route != ROUTE_DB and not self.is_storage_disabled():
+                # written in the filestore or in another object storage
+                self = self.with_context(
+                    storage_location=route, object_storage_mimetype=mimetype
+                )
+                return super(IrAttachment, self)._get_datas_related_values(
+                    data, mimetype
+                )
+            keep_in_db = self._store_in_db_instead_of_object_storage(data, mimetype)
+            if not keep_in_db and self._object_storage_write_behind(data):
+                # staged in the database until the cron uploads it, the
+                # content is read from the database in the meantime
+                self._object_storage_trigger_upload()
+                keep_in_db = True
+            if keep_in_db:
                 # compute the fields that depend on datas
                 bin_data = data
                 values = {
@@ -196,12 +664,53 @@ class IrAttachment(models.Model):
                     "db_datas": data,
                 }
                 return values
-        return super()._get_datas_related_values(data, mimetype)
+        # _file_write needs the mimetype to know if the file is compressed
+        self = self.with_context(object_storage_mimetype=mimetype)
+        return super(IrAttachment, self)._get_datas_related_values(data, mimetype)
+
+    def _transaction_files_cache(self):
+        """Return the cache of the files read by the current transaction
+
+        It is dropped at the commit or the rollback, and holds at most
+        ``ODOO_ATTACHMENT_TRANSACTION_CACHE_MAX_BYTES`` bytes (default 64
+        MiB, 0 disables it).
+        """
+        max_bytes = env_int(
+            "ODOO_ATTACHMENT_TRANSACTION_CACHE_MAX_BYTES", 64 * 1024 * 1024
+        )
+        if not max_bytes:
+            return None
+        # the data of the callbacks is cleared when the transaction ends
+        data = self.env.cr.postcommit.data
+        cache = data.get("object_storage_files")
+        if cache is None:
+            cache = data["object_storage_files"] = TransactionFilesCache(max_bytes)
+        return cache
 
     @api.model
     def _file_read(self, fname):
         if self._is_file_from_a_store(fname):
-            return self._store_file_read(fname)
+            files_cache = cache = None
+            if is_content_key(fname):
+                files_cache = self._transaction_files_cache()
+                cache = get_disk_cache()
+            if files_cache is not None:
+                content = files_cache.get(fname)
+                if content is not None:
+                    return content
+            content = cache.get(fname) if cache is not None else None
+            if content is None:
+                if fname in missing_files:
+                    return b""
+                content = self._object_storage_decode(
+                    fname, self._store_file_read(fname)
+                )
+                # an empty content means the file is missing on the store
+                if content and cache is not None:
+                    cache.put(fname, content)
+            if content and files_cache is not None:
+                files_cache.put(fname, content)
+            return content
         else:
             return super()._file_read(fname)
 
@@ -209,41 +718,827 @@ class IrAttachment(models.Model):
         storage = fname.partition("://")[0]
         raise NotImplementedError("No implementation for %s" % (storage,))
 
+    def read(self, fields=None, load="_classic_read"):
+        fields = self.check_field_access_rights("read", fields)
+        if not self.env.context.get("bin_size") or "raw" not in fields:
+            return super().read(fields, load=load)
+        # unlike 'datas', 'raw' is computed from the content of the file
+        # even when only its size is requested, answer from 'file_size'
+        # instead of reading the files of the object storages
+        result = super().read([name for name in fields if name != "raw"], load=load)
+        attachments = self.browse([row["id"] for row in result])
+        stored = attachments.filtered(
+            lambda attach: attach.store_fname
+            and self._is_file_from_a_store(attach.store_fname)
+        )
+        others = attachments - stored
+        raw_values = {}
+        if others:
+            for row in super(IrAttachment, others).read(["raw"], load=load):
+                raw_values[row["id"]] = row["raw"]
+        stored_ids = set(stored.ids)
+        for row in result:
+            if row["id"] in stored_ids:
+                row["raw"] = human_size(self.browse(row["id"]).file_size)
+            else:
+                row["raw"] = raw_values.get(row["id"])
+        return result
+
+    def _compute_raw(self):
+        # read the files of the object storages concurrently, the field is
+        # computed for all the prefetched records at once
+        stored = self.filtered(
+            lambda attach: attach.store_fname
+            and self._is_file_from_a_store(attach.store_fname)
+        )
+        if len(stored) < 2:
+            return super()._compute_raw()
+        contents = self._files_read(stored.mapped("store_fname"))
+        for attach in stored:
+            attach.raw = contents.get(attach.store_fname) or b""
+        super(IrAttachment, self - stored)._compute_raw()
+
+    @api.model
+    def _files_read(self, fnames):
+        """Read several files of the object storages
+
+        Return a dictionary of the contents by filename. The files are read
+        from the local cache or concurrently from their stores.
+        """
+        contents = {}
+        files_cache = self._transaction_files_cache()
+        cache = get_disk_cache()
+        missing = []
+        for fname in set(fnames):
+            content = None
+            if is_content_key(fname):
+                if files_cache is not None:
+                    content = files_cache.get(fname)
+                if content is None and cache is not None:
+                    content = cache.get(fname)
+                    if content is not None and files_cache is not None:
+                        files_cache.put(fname, content)
+            if content is None and fname in missing_files:
+                content = b""
+            if content is None:
+                missing.append(fname)
+            else:
+                contents[fname] = content
+        if missing:
+            read = {
+                fname: self._object_storage_decode(fname, content)
+                for fname, content in self._store_files_read(missing).items()
+            }
+            for fname, content in read.items():
+                # an empty content means the file is missing on the store
+                if not content or not is_content_key(fname):
+                    continue
+                if cache is not None:
+                    cache.put(fname, content)
+                if files_cache is not None:
+                    files_cache.put(fname, content)
+            contents.update(read)
+        return contents
+
+    def _store_files_read(self, fnames):
+        """Read several files from their stores
+
+        Return a dictionary of the contents by filename. The files are
+        read by a pool of ``ODOO_ATTACHMENT_READ_WORKERS`` threads (default
+        8): reading N files costs about the latency of a single read. The
+        stores implementations of ``_store_file_read`` must not use the
+        database.
+        """
+        if len(fnames) == 1:
+            return {fnames[0]: self._store_file_read(fnames[0])}
+        max_workers = min(env_int("ODOO_ATTACHMENT_READ_WORKERS", 8), len(fnames))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return dict(zip(fnames, executor.map(self._store_file_read, fnames)))
+
+    def _object_storage_decode(self, fname, content):
+        """Decompress the content of a file read from its store"""
+        codec = compression.codec_of(fname)
+        if codec and content:
+            return compression.decompress(codec, content)
+        return content
+
+    @api.model
+    def _file_read_iter(self, fname, start=0, decode=True):
+        """Return an iterator over the content of a file of a store
+
+        The content is read by chunks, starting at the byte ``start``. It is
+        used to stream files in HTTP responses: it may be consumed once the
+        cursor is closed, so neither this method nor the stores
+        implementations may use the database.
+
+        When ``decode`` is False, the content of compressed files is
+        returned as stored, compressed.
+        """
+        codec = compression.codec_of(fname)
+        if (decode or not codec) and is_content_key(fname):
+            cache = get_disk_cache()
+            if cache is not None:
+                cached = cache.open(fname)
+                if cached is not None:
+                    return ClosingIterator(
+                        iter_file(cached, start, stream_chunk_size()), cached
+                    )
+        if fname in missing_files:
+            return iter(())
+        if codec and decode:
+            # the position in the compressed file is unknown
+            chunks = self._store_file_read_iter(
+                fname, start=0, chunk_size=stream_chunk_size()
+            )
+            return ClosingIterator(
+                compression.iter_decompress(codec, chunks, start=start), chunks
+            )
+        return self._store_file_read_iter(
+            fname, start=start, chunk_size=stream_chunk_size()
+        )
+
+    def _store_file_read_iter(self, fname, start=0, chunk_size=None):
+        """Return an iterator over the content of a file of a store
+
+        Stores able to stream the content override this method, the default
+        implementation reads the whole file at once.
+        """
+        content = self._store_file_read(fname)
+        return iter_bytes(content or b"", start, chunk_size or stream_chunk_size())
+
+    def _store_file_missing(self, fname):
+        """Called by the stores when a file is missing
+
+        The file is not read again from its store for
+        ``ODOO_ATTACHMENT_MISSING_TTL`` seconds (default 60). The reads of
+        missing files are reported in the logs every
+        ``ODOO_ATTACHMENT_MISSING_REPORT_INTERVAL`` seconds (default 3600).
+        It must not use the database.
+        """
+        _logger.info("attachment '%s' missing on object storage", fname)
+        missing_files.add(fname)
+
     def _store_file_write(self, key, bin_data):
         storage = self.storage()
         raise NotImplementedError("No implementation for %s" % (storage,))
 
+    def _store_file_write_fileobj(self, key, fileobj, size):
+        """Write a file in the current store from a file object
+
+        Stores override this method to upload the content while it is read
+        from ``fileobj``, without loading it in memory.
+        """
+        return self._store_file_write(key, fileobj.read())
+
     def _store_file_delete(self, fname):
         storage = fname.partition("://")[0]
         raise NotImplementedError("No implementation for %s" % (storage,))
 
+    def _store_files_delete(self, fnames):
+        """Delete several files from the object storages
+
+        Stores supporting batch deletions override this method to delete
+        the files of their own in a few requests, and pass the others to
+        ``super()``.
+        """
+        for fname in fnames:
+            self._store_file_delete(fname)
+
+    def _store_file_copy(self, fname, key):
+        """Copy a file on the server side to a key of the current store
+
+        Return the filename of the copy.
+        """
+        storage = fname.partition("://")[0]
+        raise NotImplementedError("No implementation for %s" % (storage,))
+
+    def _store_file_name(self, key):
+        """Return the filename of a key written in the current store
+
+        Used to know if a file already exists before writing it, stores
+        override this method. It must not use the network.
+        """
+        return None
+
+    def _store_file_exists(self, fname):
+        """Return whether a file exists in its store (e.g. HEAD request)"""
+        return False
+
+    @api.model
+    def _store_file_lookup(self, key, size):
+        """Return the filename of the key if it already exists in the store
+
+        As the keys are checksums of the content, an existing file does not
+        need to be uploaded again. The files written or found by the process
+        are remembered for ``ODOO_ATTACHMENT_DEDUP_TTL`` seconds (default
+        600). Files above ``ODOO_ATTACHMENT_DEDUP_MIN_SIZE`` bytes (default
+        1 MiB) are looked up in the store before being uploaded, for smaller
+        files the lookup would cost as much as the upload.
+        """
+        fname = self._store_file_name(key)
+        if not fname:
+            return None
+        if fname in known_files:
+            known_files.count(hit=True)
+            return fname
+        if size >= env_int("ODOO_ATTACHMENT_DEDUP_MIN_SIZE", 1024 * 1024):
+            if self._store_file_exists(fname):
+                known_files.count(remote_hit=True)
+                known_files.add(fname)
+                return fname
+        known_files.count()
+        return None
+
+    @api.model
+    def _object_storage_key(self, checksum):
+        """Return the key of a file in the object storage
+
+        The layout of the keys is configured with
+        ``ODOO_ATTACHMENT_KEY_LAYOUT`` (default ``{sha}``), where ``{db}`` is
+        replaced by the name of the database, ``{sha}`` by the checksum of
+        the content, and slices like ``{sha[:2]}`` by a part of them, for
+        instance ``{db}/{sha[:2]}/{sha[2:4]}/{sha}``. Spreading the keys
+        over prefixes raises the request rate allowed by some stores. The
+        filenames of the attachments contain the full key, so files written
+        with different layouts can be read.
+        """
+        layout = os.environ.get("ODOO_ATTACHMENT_KEY_LAYOUT") or "{sha}"
+        if "{sha}" not in layout:
+            _logger.error(
+                "ODOO_ATTACHMENT_KEY_LAYOUT must contain the full checksum"
+                " ({sha}), the default layout is used"
+            )
+            layout = "{sha}"
+        return format_key(layout, self.env.cr.dbname, checksum)
+
     @api.model
     def _file_write(self, bin_data, checksum):
         location = self.env.context.get("storage_location") or self._storage()
         if location in self._get_stores():
             key = self.env.context.get("force_storage_key")
+            mimetype = self.env.context.get("object_storage_mimetype")
+            codec = None
             if not key:
-                key = self._compute_checksum(bin_data)
-            filename = self._store_file_write(key, bin_data)
+                codec = self._object_storage_codec(len(bin_data), mimetype)
+            filename = self._object_storage_write(
+                bin_data, key=key, codec=codec, mimetype=mimetype
+            )
         else:
             filename = super()._file_write(bin_data, checksum)
         return filename
 
+    def _object_storage_write(self, bin_data, key=None, codec=None, mimetype=None):
+        """Write a file in the current store, unless it already exists
+
+        The file is compressed with ``codec`` when given, the codec is
+        recorded in the key. It must not use the database, it is called
+        from threads by the migrations.
+
+        A ``key`` given by the caller (``force_storage_key``) is not a
+        checksum, a new content can be written with the same key: the file
+        is always written.
+        """
+        if key:
+            filename = self._store_file_write(key, bin_data)
+            # a former content may have been remembered with this name
+            known_files.discard([filename])
+            missing_files.discard([filename])
+            return filename
+        key = self._object_storage_key(self._compute_checksum(bin_data))
+        if codec:
+            key += compression.CODEC_SUFFIXES[codec]
+        filename = self._store_file_lookup(key, len(bin_data))
+        if not filename:
+            if codec:
+                bin_data = compression.compress(codec, bin_data, mimetype=mimetype)
+            filename = self._store_file_write(key, bin_data)
+            known_files.add(filename)
+        missing_files.discard([filename])
+        return filename
+
+    def _object_storage_write_path(self, path, codec=None, mimetype=None):
+        """Write a file of the filesystem in the current store
+
+        The checksum is computed and the file uploaded while they are read
+        from the disk, by chunks, so the memory used does not depend on the
+        size of the file. Files to compress are read at once. Return
+        ``(store_fname, file_size, checksum)``. Like
+        ``_object_storage_write``, it must not use the database.
+        """
+        if codec:
+            with open(path, "rb") as file:
+                bin_data = file.read()
+            filename = self._object_storage_write(
+                bin_data, codec=codec, mimetype=mimetype
+            )
+            return filename, len(bin_data), self._compute_checksum(bin_data)
+        size = os.path.getsize(path)
+        checksum = self._compute_checksum_file(path)
+        key = self._object_storage_key(checksum)
+        filename = self._store_file_lookup(key, size)
+        if not filename:
+            with open(path, "rb") as file:
+                filename = self._store_file_write_fileobj(key, file, size)
+            known_files.add(filename)
+        missing_files.discard([filename])
+        return filename, size, checksum
+
+    def _compute_checksum_file(self, path):
+        """Same as ``_compute_checksum`` reading the file by chunks"""
+        sha = hashlib.sha1()
+        with open(path, "rb") as file:
+            for chunk in iter(lambda: file.read(stream_chunk_size()), b""):
+                sha.update(chunk)
+        return sha.hexdigest()
+
     @api.model
     def _file_delete(self, fname):
         if self._is_file_from_a_store(fname):
-            cr = self.env.cr
-            # using SQL to include files hidden through unlink or due to record
-            # rules
-            cr.execute(
-                "SELECT COUNT(*) FROM ir_attachment " "WHERE store_fname = %s", (fname,)
-            )
-            count = cr.fetchone()[0]
-            if not count:
-                self._store_file_delete(fname)
+            # the file is deleted later by _object_storage_gc, if no
+            # attachment uses it anymore
+            self.env["object.storage.gc"]._mark(fname)
         else:
             super()._file_delete(fname)
 
+    @api.model
+    def _object_storage_gc(self):
+        """Delete the queued files no longer used by any attachment
+
+        Called by a cron. The files are processed by batches of
+        ``ODOO_ATTACHMENT_GC_BATCH_SIZE`` (default 1000), once they have been
+        queued for ``ODOO_ATTACHMENT_GC_DELAY`` seconds (default 3600).
+        """
+        if self.is_storage_disabled():
+            return
+        batch_size = env_int("ODOO_ATTACHMENT_GC_BATCH_SIZE", 1000)
+        delay = env_int("ODOO_ATTACHMENT_GC_DELAY", 3600)
+        total = 0
+        while True:
+            count, to_delete = self._object_storage_gc_batch(batch_size, delay)
+            # disable pylint error because this is a valid commit: it
+            # releases the lock on ir_attachment before the files are
+            # deleted in the object storage
+            self.env.cr.commit()  # pylint: disable=invalid-commit
+            if to_delete:
+                # the files are no longer used, and not used again before
+                # the delay of the queue
+                known_files.discard(to_delete)
+                self._store_files_delete(to_delete)
+            total += count
+            if count < batch_size:
+                break
+        if total:
+            _logger.info("%d files processed by the object storage gc", total)
+
+    @api.model
+    def _object_storage_gc_batch(self, batch_size, delay):
+        """Unqueue one batch of the queue
+
+        Return the number of unqueued files and the files to delete, once
+        the transaction is committed.
+        """
+        cr = self.env.cr
+        cr.execute(
+            "SELECT id, store_fname FROM object_storage_gc "
+            "WHERE queued_at <= (now() at time zone 'UTC') "
+            "                    - %s * interval '1 second' "
+            "ORDER BY id "
+            "LIMIT %s "
+            "FOR UPDATE SKIP LOCKED",
+            (delay, batch_size),
+        )
+        rows = cr.fetchall()
+        if not rows:
+            return 0, []
+        fnames = {row[1] for row in rows}
+        # like the garbage collector of the filestore, wait for the
+        # transactions writing attachments, they could use the files
+        cr.execute("LOCK ir_attachment IN SHARE MODE")
+        # using SQL to include files hidden through unlink or due to record
+        # rules
+        cr.execute(
+            "SELECT DISTINCT store_fname FROM ir_attachment "
+            "WHERE store_fname IN %s",
+            (tuple(fnames),),
+        )
+        used = {row[0] for row in cr.fetchall()}
+        to_delete = [
+            fname
+            for fname in sorted(fnames - used)
+            if self._is_file_from_a_store(fname)
+        ]
+        cr.execute(
+            "DELETE FROM object_storage_gc WHERE id IN %s",
+            (tuple(row[0] for row in rows),),
+        )
+        return len(rows), to_delete
+
+    @api.model
+    def _object_storage_upload_staged(self):
+        """Upload the attachments staged in the database by the write-behind
+
+        Called by a cron, triggered by the transactions staging attachments.
+        The staged attachments, stored in the database without a file and
+        written since the last complete pass, are moved to the object
+        storage. The content is read from the database until the new
+        ``store_fname`` is committed. The pass has its own progress, apart
+        from the migration of ``force_storage``.
+        """
+        if not is_true(os.environ.get("ODOO_ATTACHMENT_WRITE_BEHIND")):
+            return
+        storage = self._storage()
+        if storage not in self._get_stores() or self.is_storage_disabled(storage):
+            return
+        model_env = self.with_context(storage_location=storage)
+        migration = self.env["object.storage.migration"].sudo()._get_migration(
+            "upload_staged:{}".format(storage)
+        )
+        if not migration._lock():
+            return
+        migration._start(incremental=True)
+        query = (
+            "SELECT id FROM ir_attachment "
+            "WHERE db_datas IS NOT NULL AND store_fname IS NULL AND id > %s"
+        )
+        params = [migration.watermark]
+        if migration.since:
+            query += " AND write_date >= %s"
+            params.append(migration.since)
+        self.env.cr.execute(query + " ORDER BY id", params)
+        ids = [row[0] for row in self.env.cr.fetchall()]
+        if ids:
+            # the attachments kept in the database on purpose stay there
+            domain = [
+                ("id", "in", ids),
+                # see _force_storage_to_object_storage
+                "|",
+                ("res_field", "=", False),
+                ("res_field", "!=", False),
+            ]
+            db_domain = model_env._store_in_db_instead_of_object_storage_domain()
+            if db_domain:
+                domain = AND([domain, ["!"] + normalize_domain(db_domain)])
+            ids = model_env.search(domain, order="id").ids
+        model_env._move_attachments_to_store(ids, migration=migration)
+
+    @api.model
+    def object_storage_rekey(self):
+        """Move the files of the current store to the configured key layout
+
+        Entry point of ``_object_storage_rekey`` for RPC calls.
+        """
+        if not self.env["res.users"].browse(self.env.uid)._is_admin():
+            raise exceptions.AccessError(
+                _("Only administrators can execute this action.")
+            )
+        self._object_storage_rekey()
+
+    @api.model
+    def _object_storage_rekey(self):
+        """Move the files of the current store to the configured key layout
+
+        The files whose key does not follow ``ODOO_ATTACHMENT_KEY_LAYOUT``
+        are copied on the server side to their new key, the attachments
+        updated and the former files queued for deletion. The attachments
+        are processed by chunks of ``ODOO_ATTACHMENT_MIGRATION_CHUNK_SIZE``,
+        the copies done by ``ODOO_ATTACHMENT_MIGRATION_WORKERS`` threads and
+        the progress saved in ``object.storage.migration``, so an
+        interrupted run is resumed.
+
+        Only the files of the current bucket or container are moved, see
+        ``_object_storage_clone`` for the others.
+
+        It is not called anywhere, but can be called by scripts, or by RPC
+        through ``object_storage_rekey``.
+        """
+        self._object_storage_copy_files("rekey", "re-keying")
+
+    @api.model
+    def object_storage_clone(self):
+        """Copy the files of other buckets or containers to the current one
+
+        Entry point of ``_object_storage_clone`` for RPC calls.
+        """
+        if not self.env["res.users"].browse(self.env.uid)._is_admin():
+            raise exceptions.AccessError(
+                _("Only administrators can execute this action.")
+            )
+        self._object_storage_clone()
+
+    @api.model
+    def _object_storage_clone(self):
+        """Copy the files of other buckets or containers to the current one
+
+        Once a database is copied from another environment (e.g. production
+        to integration), its attachments still use the files of the bucket
+        or container of the source environment. They are copied on the
+        server side to the current bucket or container, and the attachments
+        updated to use the copies. The files of the source are never deleted.
+        It is processed like ``_object_storage_rekey``.
+
+        It is not called anywhere, but can be called by scripts, or by RPC
+        through ``object_storage_clone``.
+        """
+        self._object_storage_copy_files("clone", "cloning", clone=True)
+
+    @api.model
+    def _object_storage_copy_files(self, name, label, clone=False):
+        """Copy the files of the attachments of the current store by chunks"""
+        storage = self._storage()
+        if storage not in self._get_stores() or self.is_storage_disabled(storage):
+            return
+        model_env = self.with_context(storage_location=storage)
+        migration = self.env["object.storage.migration"].sudo()._get_migration(
+            "{}:{}".format(name, storage)
+        )
+        if not migration._lock():
+            return
+        if migration._start():
+            _logger.info(
+                "resuming the %s after attachment %s", label, migration.watermark
+            )
+        watermark = migration.watermark
+        self.env.cr.commit()  # pylint: disable=invalid-commit
+        chunk_size = env_int("ODOO_ATTACHMENT_MIGRATION_CHUNK_SIZE", 200)
+        max_workers = env_int("ODOO_ATTACHMENT_MIGRATION_WORKERS", 8)
+        progress = MigrationProgress("{} of {}".format(label, storage), 0)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while True:
+                # the lock is released by the commit of each chunk
+                if not migration._lock(watermark):
+                    return
+                self.env.cr.execute(
+                    "SELECT id, store_fname, checksum FROM ir_attachment "
+                    "WHERE id > %s AND store_fname LIKE %s "
+                    "ORDER BY id LIMIT %s",
+                    (watermark, "{}://%".format(storage), chunk_size),
+                )
+                rows = self.env.cr.fetchall()
+                if not rows:
+                    break
+                progress.total += len(rows)
+                done, failed = progress.done, progress.failed
+                model_env._object_storage_rekey_chunk(
+                    rows, executor, progress, clone=clone
+                )
+                migration._checkpoint(
+                    rows[-1][0],
+                    done=progress.done - done,
+                    failed=progress.failed - failed,
+                )
+                watermark = max(watermark, rows[-1][0])
+                # the copies exist on the store, commit their use
+                self.env.cr.commit()  # pylint: disable=invalid-commit
+                progress.log()
+        migration._finish()
+        self.env.cr.commit()  # pylint: disable=invalid-commit
+        progress.log(final=True)
+
+    def _object_storage_rekey_chunk(self, rows, executor, progress, clone=False):
+        """Copy the files of a chunk of attachments to their new key
+
+        With ``clone``, the files of other buckets or containers are copied
+        to the current one instead, and they are not queued for deletion.
+        """
+        # the filenames of the current bucket or container start with it
+        prefix = self._store_file_name("")
+        moves = {}
+        counts = {}
+        for __, fname, checksum in rows:
+            if fname not in moves and checksum and prefix:
+                key = self._object_storage_key(checksum)
+                codec = compression.codec_of(fname)
+                if codec:
+                    key += compression.CODEC_SUFFIXES[codec]
+                new_fname = self._store_file_name(key)
+                if clone:
+                    move = not fname.startswith(prefix)
+                else:
+                    move = fname.startswith(prefix) and new_fname != fname
+                if move:
+                    moves[fname] = key
+            if fname in moves:
+                counts[fname] = counts.get(fname, 0) + 1
+            else:
+                progress.add_done()
+
+        def copy(fname):
+            try:
+                return self._store_file_copy(fname, moves[fname])
+            except Exception:
+                _logger.exception("Could not copy %s to %s", fname, moves[fname])
+                return None
+
+        copies = []
+        for fname, new_fname in zip(moves, executor.map(copy, moves)):
+            if not new_fname:
+                progress.add_failed(counts[fname])
+                continue
+            copies.append((fname, new_fname))
+            known_files.add(new_fname)
+            if not clone:
+                self.env["object.storage.gc"]._mark(fname)
+            for __ in range(counts[fname]):
+                progress.add_done()
+        if copies:
+            # the attachments of the next chunks using the files are moved
+            # at the same time
+            self.env.cr.execute(
+                "UPDATE ir_attachment AS att "
+                "SET store_fname = v.new_fname "
+                "FROM (VALUES {}) AS v(fname, new_fname) "
+                "WHERE att.store_fname = v.fname".format(
+                    ", ".join(["(%s, %s)"] * len(copies))
+                ),
+                [param for pair in copies for param in pair],
+            )
+        self.invalidate_model(["store_fname"])
+
+    @api.model
+    def object_storage_transfer(self, source, target=None):
+        """Move the files of an object storage to another one
+
+        Entry point of ``_object_storage_transfer`` for RPC calls.
+        """
+        if not self.env["res.users"].browse(self.env.uid)._is_admin():
+            raise exceptions.AccessError(
+                _("Only administrators can execute this action.")
+            )
+        self._object_storage_transfer(source, target=target)
+
+    @api.model
+    def _object_storage_transfer(self, source, target=None):
+        """Move the files of an object storage to another one
+
+        The files of the attachments stored on ``source`` are streamed to
+        ``target`` (default: the current storage) by
+        ``ODOO_ATTACHMENT_MIGRATION_WORKERS`` threads, their checksum is
+        verified while they are sent, and the attachments are updated by
+        chunks of ``ODOO_ATTACHMENT_MIGRATION_CHUNK_SIZE``. The progress is
+        saved in ``object.storage.migration``, so an interrupted run is
+        resumed.
+
+        Both storages must be configured: the attachments not moved yet are
+        still read from ``source`` meanwhile, and its files are kept.
+
+        It is not called anywhere, but can be called by scripts, or by RPC
+        through ``object_storage_transfer``.
+        """
+        target = target or self._storage()
+        stores = self._get_stores()
+        if source not in stores or target not in stores or source == target:
+            raise exceptions.UserError(
+                _("Cannot move the files from %s to %s") % (source, target)
+            )
+        if self.is_storage_disabled(source) or self.is_storage_disabled(target):
+            return
+        model_env = self.with_context(storage_location=target)
+        migration = self.env["object.storage.migration"].sudo()._get_migration(
+            "transfer:{}:{}".format(source, target)
+        )
+        if not migration._lock():
+            return
+        if migration._start():
+            _logger.info(
+                "resuming the transfer after attachment %s", migration.watermark
+            )
+        watermark = migration.watermark
+        self.env.cr.commit()  # pylint: disable=invalid-commit
+        chunk_size = env_int("ODOO_ATTACHMENT_MIGRATION_CHUNK_SIZE", 200)
+        max_workers = env_int("ODOO_ATTACHMENT_MIGRATION_WORKERS", 8)
+        progress = MigrationProgress(
+            "transfer from {} to {}".format(source, target), 0
+        )
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while True:
+                # the lock is released by the commit of each chunk
+                if not migration._lock(watermark):
+                    return
+                self.env.cr.execute(
+                    "SELECT id, store_fname, checksum, file_size "
+                    "FROM ir_attachment "
+                    "WHERE id > %s AND store_fname LIKE %s "
+                    "ORDER BY id LIMIT %s",
+                    (watermark, "{}://%".format(source), chunk_size),
+                )
+                rows = self.env.cr.fetchall()
+                if not rows:
+                    break
+                progress.total += len(rows)
+                done, failed = progress.done, progress.failed
+                model_env._object_storage_transfer_chunk(rows, executor, progress)
+                migration._checkpoint(
+                    rows[-1][0],
+                    done=progress.done - done,
+                    failed=progress.failed - failed,
+                )
+                watermark = max(watermark, rows[-1][0])
+                # the files exist on the target, commit their use
+                self.env.cr.commit()  # pylint: disable=invalid-commit
+                progress.log()
+        migration._finish()
+        self.env.cr.commit()  # pylint: disable=invalid-commit
+        progress.log(final=True)
+
+    def _object_storage_transfer_chunk(self, rows, executor, progress):
+        """Move the files of a chunk of attachments to the current store"""
+        files = {}
+        counts = {}
+        for __, fname, checksum, file_size in rows:
+            if not checksum:
+                _logger.error("Could not move %s, its checksum is unknown", fname)
+                progress.add_failed()
+                continue
+            files[fname] = (checksum, file_size or 0)
+            counts[fname] = counts.get(fname, 0) + 1
+
+        def transfer(fname):
+            checksum, file_size = files[fname]
+            try:
+                return self._object_storage_transfer_file(fname, checksum, file_size)
+            except Exception:
+                _logger.exception("Could not move %s", fname)
+                return None
+
+        moves = []
+        for fname, new_fname in zip(files, executor.map(transfer, files)):
+            if not new_fname:
+                progress.add_failed(counts[fname])
+                continue
+            moves.append((fname, new_fname))
+            for __ in range(counts[fname]):
+                progress.add_done(files[fname][1])
+        if moves:
+            # the attachments modified meanwhile no longer use the former
+            # file and are left untouched
+            self.env.cr.execute(
+                "UPDATE ir_attachment AS att "
+                "SET store_fname = v.new_fname "
+                "FROM (VALUES {}) AS v(fname, new_fname) "
+                "WHERE att.store_fname = v.fname".format(
+                    ", ".join(["(%s, %s)"] * len(moves))
+                ),
+                [param for pair in moves for param in pair],
+            )
+        self.invalidate_model(["store_fname"])
+
+    def _object_storage_transfer_file(self, fname, checksum, file_size):
+        """Copy a file to the current store and return its new filename
+
+        The content is streamed from its store and its checksum verified.
+        Called from a thread of the migration pool: it must not use the
+        database cursor.
+        """
+        key = self._object_storage_key(checksum)
+        codec = compression.codec_of(fname)
+        if codec:
+            key += compression.CODEC_SUFFIXES[codec]
+        # the file may already be used by attachments of the target: never
+        # write an unverified content under its key
+        new_fname = self._store_file_name(key)
+        if new_fname in known_files or self._store_file_exists(new_fname):
+            known_files.add(new_fname)
+            missing_files.discard([new_fname])
+            return new_fname
+        if codec:
+            # the size of the compressed file is unknown, it is checked at
+            # once and sent as is
+            content = self._store_file_read(fname)
+            decoded = self._object_storage_decode(fname, content)
+            if not content or self._compute_checksum(decoded) != checksum:
+                raise exceptions.UserError(_("Checksum mismatch for %s") % fname)
+            new_fname = self._store_file_write(key, content)
+        else:
+            # the content is verified while it is sent to a temporary key,
+            # then copied to its key on the server side
+            tmp_fname = None
+            chunks = self._store_file_read_iter(fname, chunk_size=stream_chunk_size())
+            with ChecksumReader(chunks) as reader:
+                try:
+                    # the stores expect full reads, e.g. for the parts
+                    tmp_fname = self._store_file_write_fileobj(
+                        "tmp/%s" % uuid.uuid4().hex,
+                        io.BufferedReader(reader),
+                        file_size,
+                    )
+                    # the whole file has been sent
+                    valid = (
+                        reader.read() == b""
+                        and reader.size == file_size
+                        and reader.sha.hexdigest() == checksum
+                    )
+                    if not valid:
+                        raise exceptions.UserError(
+                            _("Checksum mismatch for %s") % fname
+                        )
+                    new_fname = self._store_file_copy(tmp_fname, key)
+                finally:
+                    if tmp_fname:
+                        self._store_file_delete(tmp_fname)
+        known_files.add(new_fname)
+        missing_files.discard([new_fname])
+        return new_fname
+
     @api.model
     def _is_file_from_a_store(self, fname):
         for store_name in self._get_stores():
@@ -354,39 +1649,145 @@ class IrAttachment(models.Model):
 
         with self.do_in_new_env(new_cr=new_cr) as new_env:
             model_env = new_env["ir.attachment"].with_context(prefetch_fields=False)
-            attachment_ids = model_env.search(domain).ids
+            migration = new_env["object.storage.migration"].sudo()._get_migration(
+                "to_db:{}".format(storage)
+            )
+            if not migration._lock():
+                return
+            if migration._start():
+                _logger.info(
+                    "resuming the migration to DB after attachment %s",
+                    migration.watermark,
+                )
+            attachment_ids = model_env.search(
+                AND([domain, migration._domain()]), order="id"
+            ).ids
             if not attachment_ids:
+                migration._finish()
                 return
-            total = len(attachment_ids)
-            start_time = time.time()
             _logger.info(
-                "Moving %d attachments from %s to" " DB for fast access", total, storage
-            )
-            current = 0
-            for attachment_id in attachment_ids:
-                current += 1
-                # if we browse attachments outside of the loop, the first
-                # access to 'datas' will compute all the 'datas' fields at
-                # once, which means reading hundreds or thousands of files at
-                # once, exhausting memory
-                attachment = model_env.browse(attachment_id)
-                # this write will read the datas from the Object Storage and
-                # write them back in the DB (the logic for location to write is
-                # in the 'datas' inverse computed field)
-                attachment.write({"datas": attachment.datas})
-                # as the file will potentially be dropped on the bucket,
-                # we should commit the changes here
-                new_env.cr.commit()
-                if current % 100 == 0 or total - current == 0:
-                    _logger.info(
-                        "attachment %s/%s after %.2fs",
-                        current,
-                        total,
-                        time.time() - start_time,
+                "Moving %d attachments from %s to DB for fast access",
+                len(attachment_ids),
+                storage,
+            )
+            chunk_size = env_int("ODOO_ATTACHMENT_MIGRATION_CHUNK_SIZE", 200)
+            max_workers = env_int("ODOO_ATTACHMENT_MIGRATION_WORKERS", 8)
+            progress = MigrationProgress(
+                "migration from {} to DB".format(storage), len(attachment_ids)
+            )
+            watermark = migration.watermark
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                for chunk_ids in split_every(chunk_size, attachment_ids):
+                    # the lock is released by the commit of each chunk
+                    if not migration._lock(watermark):
+                        return
+                    done, failed = progress.done, progress.failed
+                    skipped = progress.skipped
+                    model_env._move_attachment_chunk_to_db(
+                        chunk_ids, storage, executor, progress
+                    )
+                    migration._checkpoint(
+                        chunk_ids[-1],
+                        done=progress.done - done,
+                        failed=progress.failed - failed,
+                        skipped=progress.skipped - skipped,
                     )
+                    watermark = max(watermark, chunk_ids[-1])
+                    # as the files will potentially be dropped on the bucket,
+                    # we should commit the changes here
+                    new_env.cr.commit()  # pylint: disable=invalid-commit
+                    progress.log()
+            progress.log(final=True)
+            migration._finish()
+
+    def _move_attachment_chunk_to_db(self, ids, storage, executor, progress):
+        """Move a chunk of attachments from the object storage to the database
+
+        The files are downloaded concurrently by batches holding at most
+        ``ODOO_ATTACHMENT_MIGRATION_MAX_BYTES`` bytes (default 64 MiB) in
+        memory, each batch is written with a single UPDATE.
+        """
+        cr = self.env.cr
+        cr.execute(
+            "SELECT id, store_fname, file_size FROM ir_attachment "
+            "WHERE id IN %s AND store_fname LIKE %s "
+            "ORDER BY id "
+            "FOR UPDATE SKIP LOCKED",
+            (tuple(ids), "{}://%".format(storage)),
+        )
+        rows = cr.fetchall()
+        # locked by another transaction, or moved in the meantime
+        locked_ids = set(ids) - {row[0] for row in rows}
+        for attachment_id in sorted(locked_ids):
+            _logger.info("attachment %s skipped, it is locked", attachment_id)
+        progress.add_skipped(len(locked_ids))
+
+        max_bytes = env_int("ODOO_ATTACHMENT_MIGRATION_MAX_BYTES", 64 * 1024 * 1024)
+        batch, batch_bytes = [], 0
+        for row in rows:
+            size = row[2] or 0
+            if batch and batch_bytes + size > max_bytes:
+                self._move_attachment_batch_to_db(batch, executor, progress)
+                batch, batch_bytes = [], 0
+            batch.append(row)
+            batch_bytes += size
+        if batch:
+            self._move_attachment_batch_to_db(batch, executor, progress)
+        self.invalidate_model()
+
+    def _move_attachment_batch_to_db(self, rows, executor, progress):
+        fnames = list({fname for __, fname, __ in rows})
+        contents = dict(zip(fnames, executor.map(self._download_from_store, fnames)))
+        values = []
+        for attachment_id, fname, __ in rows:
+            content = contents[fname]
+            if not content:
+                _logger.error(
+                    "Could not migrate attachment %s to DB, file %s is missing",
+                    attachment_id,
+                    fname,
+                )
+                progress.add_failed()
+                continue
+            values.append((attachment_id, psycopg2.Binary(content), len(content)))
+            progress.add_done(len(content))
+        if not values:
+            return
+        self.env.cr.execute(
+            "UPDATE ir_attachment AS att "
+            "SET db_datas = v.db_datas, "
+            "    store_fname = NULL, "
+            "    file_size = v.file_size "
+            "FROM (VALUES {}) AS v(id, db_datas, file_size) "
+            "WHERE att.id = v.id".format(", ".join(["(%s, %s, %s)"] * len(values))),
+            [param for value in values for param in value],
+        )
+        moved = {fname for attachment_id, fname, __ in rows if contents[fname]}
+        for fname in moved:
+            # the file is deleted by the gc if no attachment uses it anymore
+            self._file_delete(fname)
+
+    def _download_from_store(self, fname):
+        """Read a file for a migration, None on failure
+
+        Called from a thread of the migration pool: it must not use the
+        database cursor.
+        """
+        try:
+            return self._object_storage_decode(fname, self._store_file_read(fname))
+        except Exception:
+            _logger.exception("Could not read %s from the object storage", fname)
+            return None
 
     @api.model
-    def _force_storage_to_object_storage(self, new_cr=False):
+    def _force_storage_to_object_storage(self, new_cr=False, incremental=False):
+        """Move the attachments to the object storage
+
+        The progress is saved in ``object.storage.migration``: an interrupted
+        migration is resumed after the last processed attachment. When
+        ``incremental`` is set, only the attachments written since the last
+        complete migration are checked.
+        """
         _logger.info("migrating files to the object storage")
         storage = self.env.context.get("storage_location") or self._storage()
         if self.is_storage_disabled(storage):
@@ -408,45 +1809,261 @@ class IrAttachment(models.Model):
         # serialization issues due to concurrent updates on attachments during
         # the installation
         with self.do_in_new_env(new_cr=new_cr) as new_env:
-            model_env = new_env["ir.attachment"]
-            ids = model_env.search(domain).ids
-            files_to_clean = []
-            for attachment_id in ids:
-                try:
-                    with new_env.cr.savepoint():
-                        # check that no other transaction has
-                        # locked the row, don't send a file to storage
-                        # in that case
-                        self.env.cr.execute(
-                            "SELECT id "
-                            "FROM ir_attachment "
-                            "WHERE id = %s "
-                            "FOR UPDATE NOWAIT",
-                            (attachment_id,),
-                            log_exceptions=False,
-                        )
+            model_env = new_env["ir.attachment"].with_context(
+                storage_location=storage
+            )
+            migration = new_env["object.storage.migration"].sudo()._get_migration(
+                "to_object_storage:{}".format(storage)
+            )
+            if not migration._lock():
+                return
+            if migration._start(incremental=incremental):
+                _logger.info(
+                    "resuming the migration to the object storage after"
+                    " attachment %s",
+                    migration.watermark,
+                )
+            ids = model_env.search(
+                AND([domain, migration._domain()]), order="id"
+            ).ids
+            model_env._move_attachments_to_store(ids, migration=migration)
+
+    def _move_attachments_to_store(self, ids, migration=None):
+        """Move the attachments to the object storage, by chunks
+
+        The files are read and uploaded concurrently by a pool of threads,
+        the changes are committed after each chunk and the files moved
+        from the filesystem are cleaned at the same time.
+
+        The chunk size and the number of threads can be configured with
+        ``ODOO_ATTACHMENT_MIGRATION_CHUNK_SIZE`` (default 200) and
+        ``ODOO_ATTACHMENT_MIGRATION_WORKERS`` (default 8).
+
+        When a ``object.storage.migration`` record is given, the progress is
+        saved with each chunk.
+        """
+        if not ids:
+            if migration:
+                migration._finish()
+            return
+        storage = self.env.context.get("storage_location") or self._storage()
+        chunk_size = env_int("ODOO_ATTACHMENT_MIGRATION_CHUNK_SIZE", 200)
+        max_workers = env_int("ODOO_ATTACHMENT_MIGRATION_WORKERS", 8)
+        progress = MigrationProgress(
+            "migration to {}".format(storage), len(ids)
+        )
+        watermark = migration.watermark if migration else None
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for chunk_ids in split_every(chunk_size, ids):
+                # the lock is released by the commit of each chunk
+                if migration and not migration._lock(watermark):
+                    return
+                done, failed = progress.done, progress.failed
+                skipped = progress.skipped
+                files_to_clean = self._move_attachment_chunk_to_store(
+                    chunk_ids, executor, max_workers, progress
+                )
+                if migration:
+                    migration._checkpoint(
+                        chunk_ids[-1],
+                        done=progress.done - done,
+                        failed=progress.failed - failed,
+                        skipped=progress.skipped - skipped,
+                    )
+                    watermark = max(watermark, chunk_ids[-1])
+                # delete the files from the filesystem once we know the
+                # changes have been committed in ir.attachment
+                # disable pylint error because the files are deleted only
+                # once committed
+                self.env.cr.commit()  # pylint: disable=invalid-commit
+                if files_to_clean:
+                    clean_fs(files_to_clean)
+                progress.log()
+        if migration:
+            migration._finish()
+            self.env.cr.commit()  # pylint: disable=invalid-commit
+        progress.log(final=True)
+
+    def _move_attachment_chunk_to_store(self, ids, executor, max_workers, progress):
+        """Move a chunk of attachments on the object storage
+
+        Return the paths of the files to delete from the filesystem
+        once the changes are committed.
+        """
+        cr = self.env.cr
+        # check that no other transaction has locked the rows, don't send a
+        # file to storage in that case, they will be migrated on the next run
+        cr.execute(
+            "SELECT id, store_fname, mimetype, file_size, "
+            "       db_datas IS NOT NULL, res_model, res_field "
+            "FROM ir_attachment "
+            "WHERE id IN %s "
+            "ORDER BY id "
+            "FOR UPDATE SKIP LOCKED",
+            (tuple(ids),),
+        )
+        rows = cr.fetchall()
+        # they are being written, the next incremental pass checks them
+        locked_ids = set(ids) - {row[0] for row in rows}
+        for attachment_id in sorted(locked_ids):
+            _logger.info("attachment %s skipped, it is locked", attachment_id)
+        progress.add_skipped(len(locked_ids))
+
+        fs_fnames = []
+        results = []
+        pending = set()
 
-                        # This is a trick to avoid having the 'datas'
-                        # function fields computed for every attachment on
-                        # each iteration of the loop. The former issue
-                        # being that it reads the content of the file of
-                        # ALL the attachments on each loop.
-                        new_env.clear()
-                        attachment = model_env.browse(attachment_id)
-                        path = attachment._move_attachment_to_store()
-                        if path:
-                            files_to_clean.append(path)
-                except psycopg2.OperationalError:
+        def collect(done):
+            for future in done:
+                result = future.result()
+                if result:
+                    results.append(result)
+                    progress.add_done(result[2])
+                else:
+                    progress.add_failed()
+
+        for row in rows:
+            attachment_id, fname, mimetype, file_size, has_db_datas = row[:5]
+            res_model, res_field = row[5:]
+            if fname and self._is_file_from_a_store(fname):
+                # e.g. the old 'store_fname' without the bucket name
+                bin_data = None
+            elif fname:
+                bin_data = None
+                fs_fnames.append(fname)
+            elif has_db_datas:
+                bin_data = b""
+            else:
+                # no content at all, nothing to move
+                progress.add_done()
+                continue
+            route = self._object_storage_route(
+                file_size or 0, mimetype or "", res_model, res_field
+            )
+            if route:
+                if route == ROUTE_DB:
+                    in_place = not fname
+                elif route == ROUTE_FILE:
+                    in_place = fname and not self._is_file_from_a_store(fname)
+                else:
+                    in_place = fname and fname.startswith("%s://" % route)
+                if not in_place:
+                    # small files and assets are moved in the database, other
+                    # routed files in their storage, the ORM takes care of it
+                    self.browse(attachment_id)._move_attachment_to_store()
+                progress.add_done(file_size)
+                continue
+            if has_db_datas and not fname:
+                cr.execute(
+                    "SELECT db_datas FROM ir_attachment WHERE id = %s",
+                    (attachment_id,),
+                )
+                bin_data = bytes(cr.fetchone()[0] or b"")
+            if len(pending) >= max_workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+            pending.add(
+                executor.submit(
+                    self._upload_attachment_to_store,
+                    attachment_id,
+                    fname,
+                    bin_data,
+                    codec=self._object_storage_codec(file_size or 0, mimetype),
+                    mimetype=mimetype,
+                )
+            )
+        collect(pending)
+
+        if results:
+            values = ", ".join(["(%s, %s, %s, %s)"] * len(results))
+            cr.execute(
+                "UPDATE ir_attachment AS att "
+                "SET store_fname = v.store_fname, "
+                "    db_datas = NULL, "
+                "    file_size = v.file_size, "
+                "    checksum = v.checksum "
+                "FROM (VALUES {}) AS v(id, store_fname, file_size, checksum) "
+                "WHERE att.id = v.id".format(values),
+                [param for result in results for param in result],
+            )
+        self.invalidate_model()
+        return self._unreferenced_file_paths(fs_fnames)
+
+    def _upload_attachment_to_store(
+        self, attachment_id, fname, bin_data, codec=None, mimetype=None
+    ):
+        """Upload the content of an attachment on the object storage
+
+        Called from a thread of the migration pool: it must not use the
+        database cursor. Return the new values of the attachment as
+        ``(id, store_fname, file_size, checksum)`` or None on failure.
+        """
+        try:
+            if fname and not self._is_file_from_a_store(fname):
+                # files of the filestore are uploaded from the disk, without
+                # loading them in memory
+                path = self._full_path(fname)
+                if not os.path.isfile(path):
+                    _logger.error(
+                        "Could not migrate attachment %s, file %s is missing",
+                        attachment_id,
+                        fname,
+                    )
+                    return None
+                values = self._object_storage_write_path(
+                    path, codec=codec, mimetype=mimetype
+                )
+                return (attachment_id,) + values
+            if fname:
+                bin_data = self._file_read(fname)
+                if not bin_data:
                     _logger.error(
-                        "Could not migrate attachment %s to S3", attachment_id
+                        "Could not migrate attachment %s, file %s is missing",
+                        attachment_id,
+                        fname,
                     )
+                    return None
+            checksum = self._compute_checksum(bin_data)
+            store_fname = self._object_storage_write(
+                bin_data, codec=codec, mimetype=mimetype
+            )
+        except Exception:
+            _logger.exception(
+                "Could not migrate attachment %s to the object storage",
+                attachment_id,
+            )
+            return None
+        return (attachment_id, store_fname, len(bin_data), checksum)
 
-            # delete the files from the filesystem once we know the changes
-            # have been committed in ir.attachment
-            if files_to_clean:
-                new_env.cr.commit()
-                clean_fs(files_to_clean)
+    def _unreferenced_file_paths(self, fnames):
+        """Return the full paths of the filestore files no longer used"""
+        if not fnames:
+            return []
+        # several attachments can share the same file
+        self.env.cr.execute(
+            "SELECT store_fname FROM ir_attachment WHERE store_fname IN %s",
+            (tuple(set(fnames)),),
+        )
+        used = {row[0] for row in self.env.cr.fetchall()}
+        return [self._full_path(fname) for fname in set(fnames) - used]
 
     def _get_stores(self):
         """To get the list of stores activated in the system"""
         return []
+
+    @api.model
+    def _object_storage_stats(self):
+        """Return the counters of the object storage of the current process
+
+        The result is a dictionary of counters by component (e.g. the S3
+        client pool). Each store adds its own entries.
+        """
+        stats = {
+            "writes": known_files.stats(),
+            "reads": missing_files.stats(),
+            "compression": compression.compression_stats.stats(),
+        }
+        cache = get_disk_cache()
+        if cache is not None:
+            stats["disk_cache"] = cache.stats()
+        return stats
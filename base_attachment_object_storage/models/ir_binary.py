@@ -0,0 +1,321 @@
+# Copyright 2016-2019 Camptocamp SA
+# Copyright 2021 Open Source Integrators
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+import io
+import unicodedata
+from urllib.parse import quote
+
+import werkzeug.utils
+from werkzeug.datastructures import Headers
+from werkzeug.http import dump_options_header
+from werkzeug.wsgi import FileWrapper
+
+from odoo import models
+from odoo.http import STATIC_CACHE_LONG, Response, Stream, request
+
+from .. import compression
+
+# size of the reads done by the WSGI server on the file
+STREAM_BUFFER_SIZE = 64 * 1024
+
+
+def content_disposition(filename, as_attachment=False):
+    """Return the value of a Content-Disposition header"""
+    try:
+        filename.encode("ascii")
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize("NFKD", filename)
+        simple = simple.encode("ascii", "ignore").decode("ascii")
+        quoted = quote(filename, safe="")
+        names = {"filename": simple, "filename*": "UTF-8''%s" % quoted}
+    else:
+        names = {"filename": filename}
+    return dump_options_header("attachment" if as_attachment else "inline", names)
+
+
+class ObjectStorageFile(io.RawIOBase):
+    """Seekable file-like object over a file of an object storage
+
+    Nothing is read until the first call to ``read``, the content is
+    then fetched by chunks from the current position, so a seek
+    before reading (e.g. for a Range request) only fetches the bytes
+    from this position.
+
+    ``opener`` is a callable receiving the start position and
+    returning an iterator of bytes.
+    """
+
+    def __init__(self, opener, size):
+        super().__init__()
+        self._opener = opener
+        self._size = size
+        self._pos = 0
+        self._iterator = None
+        self._buffer = memoryview(b"")
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self._size
+        if offset != self._pos:
+            self._close_iterator()
+            self._pos = offset
+        return self._pos
+
+    def prefetch(self):
+        """Read the first chunk from the current position
+
+        Return whether there is content to read, e.g. False when the file
+        is missing on the object storage.
+        """
+        if self._iterator is None:
+            self._iterator = iter(self._opener(self._pos))
+        while not self._buffer:
+            try:
+                self._buffer = memoryview(next(self._iterator))
+            except StopIteration:
+                return False
+        return True
+
+    def readinto(self, buffer):
+        if not self.prefetch():
+            return 0
+        size = min(len(buffer), len(self._buffer))
+        buffer[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        self._pos += size
+        return size
+
+    def _close_iterator(self):
+        if self._iterator is not None and hasattr(self._iterator, "close"):
+            self._iterator.close()
+        self._iterator = None
+        self._buffer = memoryview(b"")
+
+    def close(self):
+        self._close_iterator()
+        super().close()
+
+
+class ObjectStorageStream(Stream):
+    """Stream of an attachment stored on an object storage
+
+    The response sends the content by chunks while it is read from the
+    object storage, the memory used does not depend on the size of the
+    file. Range requests are forwarded to the object storage, and
+    conditional requests matching the checksum are answered without
+    reading the file.
+
+    When a caller needs the whole content (``data``, ``read()``, e.g.
+    to resize an image), it is read at once and the stream behaves as
+    a regular ``data`` stream.
+
+    When ``redirect`` is set, the response is a redirection to a
+    short-lived URL of the object storage, the content is not read by
+    Odoo at all.
+
+    Compressed files are sent as stored, with a ``Content-Encoding``
+    header, to the clients accepting their encoding.
+
+    The first chunk is read before the response is returned, a file
+    missing on the object storage is answered with a 404.
+    """
+
+    type = "data"
+    attachment = None
+    store_fname = None
+    redirect = False
+    _data = None
+
+    @property
+    def data(self):
+        if self._data is None and self.attachment is not None:
+            self._data = self.attachment.raw or b""
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        self._data = value
+
+    def _open(self, start):
+        # called while the response is sent, once the cursor of the
+        # request is closed: the database must not be used from here
+        return self.attachment._file_read_iter(self.store_fname, start=start)
+
+    def _open_encoded(self, start):
+        return self.attachment._file_read_iter(
+            self.store_fname, start=start, decode=False
+        )
+
+    def _accepted_codec(self):
+        """Return the codec of the file if the client accepts it"""
+        codec = compression.codec_of(self.store_fname or "")
+        httprequest = request.httprequest
+        if (
+            codec
+            and codec in httprequest.accept_encodings
+            # the ranges apply to the encoded content
+            and "Range" not in httprequest.headers
+        ):
+            return codec
+        return None
+
+    def get_response(self, as_attachment=None, immutable=None, **send_file_kwargs):
+        if self._data is not None:
+            # the content has already been read or modified
+            return super().get_response(
+                as_attachment=as_attachment, immutable=immutable, **send_file_kwargs
+            )
+        if as_attachment is None:
+            as_attachment = self.as_attachment
+        if immutable is None:
+            immutable = self.immutable
+
+        if self.redirect:
+            url = self.attachment._store_file_redirect_url(
+                self.store_fname,
+                download_name=self.download_name,
+                mimetype=self.mimetype,
+                as_attachment=as_attachment,
+            )
+            if url:
+                res = werkzeug.utils.redirect(url, code=302, Response=Response)
+                # the url expires, the redirection must not be cached
+                res.cache_control.no_store = True
+                return res
+
+        headers = Headers()
+        if self.download_name:
+            headers.set(
+                "Content-Disposition",
+                content_disposition(self.download_name, as_attachment=as_attachment),
+            )
+
+        codec = self._accepted_codec()
+        if codec:
+            body = ObjectStorageFile(self._open_encoded, None)
+        else:
+            body = ObjectStorageFile(self._open, self.size)
+        data = FileWrapper(body, STREAM_BUFFER_SIZE)
+        res = Response(
+            data, mimetype=self.mimetype, headers=headers, direct_passthrough=True
+        )
+        if codec:
+            # the size of the compressed file is unknown, sent by chunks
+            res.headers["Content-Encoding"] = codec
+            if isinstance(self.etag, str):
+                res.set_etag("%s-%s" % (self.etag, codec))
+        else:
+            res.content_length = self.size
+            if isinstance(self.etag, str):
+                res.set_etag(self.etag)
+        if compression.codec_of(self.store_fname or ""):
+            res.vary.add("Accept-Encoding")
+        if self.last_modified:
+            res.last_modified = self.last_modified
+        max_age = send_file_kwargs.get(
+            "max_age", STATIC_CACHE_LONG if immutable else self.max_age
+        )
+        if max_age is None:
+            res.cache_control.no_cache = True
+        else:
+            if max_age > 0:
+                res.cache_control.no_cache = None
+                res.cache_control.public = True
+            res.cache_control.max_age = max_age
+        if self.conditional:
+            # answers 304 without reading the file, or seeks to the
+            # requested range
+            res = res.make_conditional(
+                request.httprequest.environ,
+                accept_ranges=not codec,
+                complete_length=None if codec else self.size,
+            )
+        if (
+            res.status_code in (200, 206)
+            and (codec or self.size)
+            and request.httprequest.method != "HEAD"
+            and not body.prefetch()
+        ):
+            # the file is missing on the object storage, the response would
+            # be shorter than its Content-Length
+            body.close()
+            res = Response(status=404)
+            res.cache_control.no_store = True
+            return res
+        if immutable and res.cache_control:
+            res.cache_control["immutable"] = None
+        res.headers["X-Content-Type-Options"] = "nosniff"
+        return res
+
+
+class IrBinary(models.AbstractModel):
+    _inherit = "ir.binary"
+
+    def _object_storage_stream(self, attachment):
+        stream = ObjectStorageStream(
+            attachment=attachment,
+            store_fname=attachment.store_fname,
+            mimetype=attachment.mimetype or None,
+            download_name=attachment.name,
+            conditional=True,
+            etag=attachment.checksum,
+            size=attachment.file_size,
+            last_modified=attachment.write_date,
+            public=attachment.public,
+            redirect=attachment._object_storage_redirect_allowed(),
+        )
+        if not stream.size:
+            # unknown size, read the whole content to get it
+            stream.size = len(stream.data)
+        return stream
+
+    def _record_to_stream(self, record, field_name):
+        """
+        Low level method responsible for the actual conversion from a
+        model record to a stream. This method is an extensible hook for
+        other modules. It is not meant to be directly called from
+        outside or the ir.binary model.
+
+        :param record: the record where to load the data from.
+        :param str field_name: the binary field where to load the data
+            from.
+        :rtype: odoo.http.Stream
+        """
+        attachment = None
+        if record._name == "ir.attachment" and field_name in (
+            "raw",
+            "datas",
+            "db_datas",
+        ):
+            attachment = record
+        elif record._name == "documents.document" and record.attachment_id:
+            attachment = record.attachment_id
+        if (
+            attachment
+            and attachment.store_fname
+            and attachment._is_file_from_a_store(attachment.store_fname)
+        ):
+            return self._object_storage_stream(attachment)
+        return super()._record_to_stream(record, field_name)
+
+
+# This part is used if the customer install tne enterprise module documents
+try:
+    from odoo.addons import documents
+
+    documents.models.ir_binary.IrBinary._record_to_stream = IrBinary._record_to_stream
+except ImportError:
+    # document enterprise module if not installed, we just ignore
+    pass
@@ -0,0 +1,43 @@
+# Copyright 2017-2019 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+from odoo import api, fields, models
+
+
+class ObjectStorageGc(models.Model):
+    """Files of the object storage that might no longer be used
+
+    When an attachment is deleted or its content replaced, its former
+    file is queued here instead of being deleted right away in the
+    transaction of the user. The files are deleted later, by batches,
+    by ``ir.attachment._object_storage_gc`` if no attachment uses them
+    anymore.
+    """
+
+    _name = "object.storage.gc"
+    _description = "Object Storage Garbage Collector Queue"
+    _log_access = False
+
+    store_fname = fields.Char(required=True, readonly=True)
+    queued_at = fields.Datetime(
+        required=True, readonly=True, default=fields.Datetime.now
+    )
+
+    _sql_constraints = [
+        (
+            "store_fname_uniq",
+            "unique(store_fname)",
+            "This file is already queued for deletion.",
+        )
+    ]
+
+    @api.model
+    def _mark(self, fname):
+        """Queue a file, using SQL as it happens while unlinking attachments"""
+        self.env.cr.execute(
+            "INSERT INTO object_storage_gc (store_fname, queued_at) "
+            "VALUES (%s, now() at time zone 'UTC') "
+            "ON CONFLICT (store_fname) DO UPDATE "
+            "SET queued_at = EXCLUDED.queued_at",
+            (fname,),
+        )
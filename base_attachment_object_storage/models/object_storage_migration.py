@@ -0,0 +1,156 @@
+# Copyright 2017-2019 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+import logging
+from datetime import timedelta
+
+from psycopg2 import errors
+
+from odoo import api, fields, models
+
+_logger = logging.getLogger(__name__)
+
+# transactions started before a pass may commit attachments after it, with
+# a write_date older than the start of the pass, the next incremental pass
+# looks a bit further back in time to catch them
+INCREMENTAL_MARGIN = timedelta(hours=1)
+
+
+class ObjectStorageMigration(models.Model):
+    """Progress of the migrations of attachments between storages
+
+    One record is kept per kind of migration and storage, for instance
+    the migration to the object storage ``s3``. The id of the last
+    processed attachment is stored after each chunk, so an interrupted
+    migration continues where it stopped instead of starting over.
+    """
+
+    _name = "object.storage.migration"
+    _description = "Object Storage Migration"
+
+    name = fields.Char(required=True, readonly=True)
+    state = fields.Selection(
+        [("running", "Running"), ("done", "Done")],
+        default="done",
+        required=True,
+        readonly=True,
+    )
+    watermark = fields.Integer(
+        readonly=True, help="Id of the last processed attachment"
+    )
+    since = fields.Datetime(
+        readonly=True,
+        help="Only the attachments written since this date are migrated "
+        "by the current pass",
+    )
+    done_count = fields.Integer(readonly=True)
+    failed_count = fields.Integer(readonly=True)
+    skipped_count = fields.Integer(
+        readonly=True,
+        help="Attachments locked by other transactions during the pass, "
+        "they are checked by the next incremental pass",
+    )
+    started_at = fields.Datetime(readonly=True)
+    finished_at = fields.Datetime(readonly=True)
+    duration = fields.Float(readonly=True, help="Duration in seconds")
+    last_success_start = fields.Datetime(
+        readonly=True,
+        help="Start of the last pass that completed without failure",
+    )
+
+    _sql_constraints = [
+        ("name_uniq", "unique(name)", "A migration with this name already exists.")
+    ]
+
+    @api.model
+    def _get_migration(self, name):
+        migration = self.search([("name", "=", name)], limit=1)
+        if not migration:
+            migration = self.create({"name": name})
+        return migration
+
+    def _lock(self, watermark=None):
+        """Lock the migration until the end of the transaction
+
+        Return False when another transaction runs it, or when it has been
+        run beyond ``watermark`` by another process since it was read: the
+        caller must then stop. The passes committing after each chunk call
+        it again before each chunk.
+        """
+        self.ensure_one()
+        # the pending changes of the migration must be in the database
+        self.flush_recordset()
+        try:
+            with self.env.cr.savepoint(flush=False):
+                self.env.cr.execute(
+                    "SELECT watermark FROM object_storage_migration "
+                    "WHERE id = %s FOR UPDATE NOWAIT",
+                    (self.id,),
+                )
+                current = self.env.cr.fetchone()[0]
+        except errors.LockNotAvailable:
+            _logger.info("migration %s is run by another process", self.name)
+            return False
+        if watermark is not None and current != watermark:
+            _logger.info("migration %s has been run by another process", self.name)
+            return False
+        return True
+
+    def _start(self, incremental=False):
+        """Start a pass or resume the interrupted one
+
+        Return whether an interrupted pass is resumed.
+        """
+        self.ensure_one()
+        if self.state == "running":
+            return True
+        since = False
+        if incremental and self.last_success_start:
+            since = self.last_success_start - INCREMENTAL_MARGIN
+        self.write(
+            {
+                "state": "running",
+                "watermark": 0,
+                "since": since,
+                "done_count": 0,
+                "failed_count": 0,
+                "skipped_count": 0,
+                "started_at": fields.Datetime.now(),
+                "finished_at": False,
+                "duration": 0,
+            }
+        )
+        return False
+
+    def _domain(self):
+        """Domain restricting the attachments to those left to migrate"""
+        self.ensure_one()
+        domain = [("id", ">", self.watermark)]
+        if self.since:
+            domain.append(("write_date", ">=", self.since))
+        return domain
+
+    def _checkpoint(self, watermark, done=0, failed=0, skipped=0):
+        self.ensure_one()
+        self.write(
+            {
+                "watermark": max(watermark, self.watermark),
+                "done_count": self.done_count + done,
+                "failed_count": self.failed_count + failed,
+                "skipped_count": self.skipped_count + skipped,
+            }
+        )
+
+    def _finish(self):
+        self.ensure_one()
+        now = fields.Datetime.now()
+        values = {
+            "state": "done",
+            "finished_at": now,
+            "duration": (now - self.started_at).total_seconds(),
+        }
+        # the skipped attachments are being written by other transactions:
+        # their write_date is recent, the next incremental pass sees them
+        if not self.failed_count:
+            values["last_success_start"] = self.started_at
+        self.write(values)
@@ -0,0 +1,121 @@
+# Copyright 2017-2019 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+from odoo.osv.expression import AND, FALSE_DOMAIN, OR, TRUE_DOMAIN, normalize_domain
+
+# where the files can be routed, besides the name of an object storage
+ROUTE_DB = "db"
+ROUTE_FILE = "file"
+
+
+class StorageRule(object):
+    """Condition on the attachments routed to a storage
+
+    The conditions are optional, a rule without condition matches every
+    attachment:
+
+    * ``mimetype``: beginning of the mimetype
+    * ``min_size`` / ``max_size``: bounds of the size in bytes, included
+    * ``res_model`` / ``res_field``: model and field of the attachment,
+      a string or a list of strings
+    * ``store``: the rule applies only when the attachments are written
+      in this object storage
+    * ``route``: ``db``, ``file`` or the name of an object storage
+    """
+
+    def __init__(
+        self,
+        route,
+        mimetype=None,
+        min_size=None,
+        max_size=None,
+        res_model=None,
+        res_field=None,
+        store=None,
+    ):
+        self.route = route
+        self.mimetype = mimetype
+        self.min_size = min_size
+        self.max_size = max_size
+        self.res_models = self._as_set(res_model)
+        self.res_fields = self._as_set(res_field)
+        self.store = store
+
+    @staticmethod
+    def _as_set(value):
+        if not value:
+            return None
+        if isinstance(value, str):
+            return frozenset([value])
+        return frozenset(value)
+
+    def match(self, size, mimetype, res_model, res_field):
+        if self.mimetype and not (mimetype or "").startswith(self.mimetype):
+            return False
+        if self.min_size is not None and size < self.min_size:
+            return False
+        if self.max_size is not None and size > self.max_size:
+            return False
+        if self.res_models is not None and res_model not in self.res_models:
+            return False
+        if self.res_fields is not None and res_field not in self.res_fields:
+            return False
+        return True
+
+    def domain(self):
+        domain = TRUE_DOMAIN
+        if self.mimetype:
+            domain = AND(
+                [domain, [("mimetype", "=like", "{}%".format(self.mimetype))]]
+            )
+        if self.min_size is not None:
+            domain = AND([domain, [("file_size", ">=", self.min_size)]])
+        if self.max_size is not None:
+            domain = AND([domain, [("file_size", "<=", self.max_size)]])
+        if self.res_models is not None:
+            domain = AND([domain, [("res_model", "in", sorted(self.res_models))]])
+        if self.res_fields is not None:
+            domain = AND([domain, [("res_field", "in", sorted(self.res_fields))]])
+        return domain
+
+
+class StorageRoutingPolicy(object):
+    """Ordered rules routing the attachments, the first matching rule wins
+
+    Built once from the system parameters and cached, see
+    ``ir.attachment._get_storage_routing_policy``.
+    """
+
+    def __init__(self, rules):
+        self.rules = rules
+        self._store_rules = {}
+
+    def _rules_for(self, store):
+        rules = self._store_rules.get(store)
+        if rules is None:
+            rules = [
+                rule for rule in self.rules if not rule.store or rule.store == store
+            ]
+            self._store_rules[store] = rules
+        return rules
+
+    def route(self, store, size, mimetype, res_model=None, res_field=None):
+        """Return where to write an attachment, None for the store itself"""
+        for rule in self._rules_for(store):
+            if rule.match(size, mimetype, res_model, res_field):
+                return rule.route
+        return None
+
+    def domain(self, store, route):
+        """Return the domain of the attachments routed to ``route``"""
+        domain = FALSE_DOMAIN
+        previous = FALSE_DOMAIN
+        for rule in self._rules_for(store):
+            rule_domain = normalize_domain(rule.domain())
+            if rule.route == route:
+                if previous != FALSE_DOMAIN:
+                    # not matched by a previous rule
+                    rule_domain = AND([rule_domain, ["!"] + normalize_domain(previous)])
+                domain = OR([domain, rule_domain])
+            previous = OR([previous, rule_domain])
+        return domain
@@ -0,0 +1,7 @@
+from . import test_compression
+from . import test_disk_cache
+from . import test_object_storage_migration
+from . import test_object_storage_stream
+from . import test_object_storage_transfer
+from . import test_object_storage_write_behind
+from . import test_storage_routing
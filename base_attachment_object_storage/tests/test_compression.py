@@ -0,0 +1,59 @@
+# Copyright 2017-2019 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+import os
+import unittest
+
+from odoo.tests.common import BaseCase
+
+from odoo.addons.base_attachment_object_storage import compression
+
+
+def split(data, size):
+    return [data[i : i + size] for i in range(0, len(data), size)]
+
+
+class TestCompression(BaseCase):
+    def setUp(self):
+        super().setUp()
+        # compressible and random parts, several blocks once compressed
+        self.data = b"".join(
+            b"line %d of the attachment\n" % i + os.urandom(16) for i in range(5000)
+        )
+
+    def _check_round_trip(self, codec):
+        compressed = compression.compress(codec, self.data, mimetype="text/plain")
+        self.assertLess(len(compressed), len(self.data))
+        self.assertEqual(compression.decompress(codec, compressed), self.data)
+        chunks = split(compressed, 1000)
+        for start in (0, 1, 999, 65536, len(self.data) - 1, len(self.data)):
+            self.assertEqual(
+                b"".join(compression.iter_decompress(codec, chunks, start=start)),
+                self.data[start:],
+                "start at %d" % start,
+            )
+        beyond = compression.iter_decompress(codec, chunks, start=len(self.data) + 5)
+        self.assertEqual(b"".join(beyond), b"")
+
+    def test_gzip_round_trip(self):
+        self._check_round_trip("gzip")
+
+    @unittest.skipIf(compression.zstandard is None, "zstandard is not installed")
+    def test_zstd_round_trip(self):
+        self._check_round_trip("zstd")
+
+    def test_gzip_is_deterministic(self):
+        # the same content is written under the same key
+        self.assertEqual(
+            compression.compress("gzip", self.data),
+            compression.compress("gzip", self.data),
+        )
+
+    def test_codec_of(self):
+        self.assertEqual(compression.codec_of("s3://bucket/abc~gzip"), "gzip")
+        self.assertEqual(compression.codec_of("s3://bucket/abc~zstd"), "zstd")
+        self.assertIsNone(compression.codec_of("s3://bucket/abc"))
+
+    def test_decompress_empty(self):
+        self.assertEqual(compression.decompress("gzip", b""), b"")
+        self.assertEqual(list(compression.iter_decompress("gzip", [])), [])
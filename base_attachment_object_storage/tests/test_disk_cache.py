@@ -0,0 +1,56 @@
+# Copyright 2017-2019 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+import os
+import tempfile
+
+from odoo.tests.common import BaseCase
+
+from odoo.addons.base_attachment_object_storage.disk_cache import AttachmentDiskCache
+
+
+class TestDiskCache(BaseCase):
+    def setUp(self):
+        super().setUp()
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.cache = AttachmentDiskCache(tmpdir.name, max_bytes=100)
+
+    def _put(self, fname, mtime):
+        self.cache.put(fname, fname.encode() * 10)
+        # the access times are tracked by the mtimes
+        path = self.cache._get_path(fname)
+        os.utime(path, (mtime, mtime))
+
+    def test_get_put(self):
+        self.assertIsNone(self.cache.get("s3://bucket/aaaa"))
+        self.cache.put("s3://bucket/aaaa", b"content")
+        self.assertEqual(self.cache.get("s3://bucket/aaaa"), b"content")
+        with self.cache.open("s3://bucket/aaaa") as cached:
+            self.assertEqual(cached.read(), b"content")
+        stats = self.cache.stats()
+        self.assertEqual(stats["hits"], 2)
+        self.assertEqual(stats["misses"], 1)
+
+    def test_evict_least_recently_used(self):
+        self._put("a", 1000)
+        self._put("b", 2000)
+        # a hit makes "a" the most recently used file
+        self.assertEqual(self.cache.get("a"), b"a" * 10)
+        self._put("c", 3000)
+        self.assertEqual(self.cache.stats()["evictions"], 0)
+        self.cache.put("d" * 8, b"d" * 80)
+        # 30 + 80 bytes exceed the 100 bytes, the oldest files are evicted
+        # until the cache is under 90 bytes
+        self.assertIsNone(self.cache.get("b"))
+        self.assertIsNone(self.cache.get("c"))
+        self.assertEqual(self.cache.get("a"), b"a" * 10)
+        self.assertEqual(self.cache.get("d" * 8), b"d" * 80)
+        stats = self.cache.stats()
+        self.assertEqual(stats["evictions"], 2)
+        self.assertEqual(stats["bytes"], 90)
+
+    def test_file_larger_than_cache(self):
+        self.cache.put("big", b"x" * 101)
+        self.assertIsNone(self.cache.get("big"))
+        self.assertEqual(self.cache.stats()["evictions"], 0)
@@ -0,0 +1,138 @@
+# Copyright 2017-2019 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+from unittest import mock
+
+from odoo.tests.common import TransactionCase
+
+from odoo.addons.base_attachment_object_storage.models import (
+    object_storage_migration,
+)
+
+
+class TestObjectStorageMigration(TransactionCase):
+    def setUp(self):
+        super().setUp()
+        self.Attachment = self.env["ir.attachment"]
+        self.migration = self.env["object.storage.migration"]._get_migration(
+            "transfer:src:dst"
+        )
+        # the migrations commit after each chunk
+        patcher = mock.patch.object(self.env.cr, "commit")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _create_attachments(self, count):
+        attachments = self.Attachment.create(
+            [
+                {"name": "a%d" % index, "raw": b"content %d" % index}
+                for index in range(count)
+            ]
+        )
+        attachments.flush_recordset()
+        for attachment in attachments:
+            self.env.cr.execute(
+                "UPDATE ir_attachment SET store_fname = %s WHERE id = %s",
+                ("src://%s" % attachment.checksum, attachment.id),
+            )
+        attachments.invalidate_recordset(["store_fname"])
+        return attachments
+
+    def _transfer(self):
+        """Run the transfer from src to dst, return the files moved"""
+        transferred = []
+
+        def _object_storage_transfer_file(self, fname, checksum, file_size):
+            transferred.append(fname)
+            return "dst://%s" % checksum
+
+        with mock.patch.multiple(
+            type(self.Attachment),
+            _get_stores=lambda self: ["src", "dst"],
+            _object_storage_transfer_file=_object_storage_transfer_file,
+        ):
+            self.Attachment._object_storage_transfer("src", target="dst")
+        return transferred
+
+    def test_resume_from_watermark(self):
+        """An interrupted pass resumes after the last processed attachment"""
+        attachments = self._create_attachments(3)
+        self.migration._start()
+        self.migration._checkpoint(attachments[0].id, done=1)
+        expected = attachments[1:].mapped("store_fname")
+        transferred = self._transfer()
+        self.assertEqual(sorted(transferred), sorted(expected))
+        # the attachment processed before the interruption is not read again
+        self.assertEqual(attachments[0].store_fname, "src://" + attachments[0].checksum)
+        for attachment in attachments[1:]:
+            self.assertEqual(attachment.store_fname, "dst://" + attachment.checksum)
+        self.assertEqual(self.migration.state, "done")
+        self.assertEqual(self.migration.watermark, attachments[-1].id)
+        self.assertEqual(self.migration.done_count, 3)
+        self.assertEqual(self.migration.failed_count, 0)
+        self.assertEqual(self.migration.last_success_start, self.migration.started_at)
+
+    def test_pass_run_by_another_process(self):
+        """A pass locked by another process is left alone"""
+        attachments = self._create_attachments(2)
+        with mock.patch.object(
+            type(self.migration), "_lock", return_value=False
+        ) as lock:
+            transferred = self._transfer()
+        lock.assert_called_once_with()
+        self.assertEqual(transferred, [])
+        self.assertEqual(self.migration.state, "done")
+        self.assertEqual(self.migration.watermark, 0)
+        for attachment in attachments:
+            self.assertEqual(attachment.store_fname, "src://" + attachment.checksum)
+
+    def test_lock_watermark(self):
+        """The pass stops when another process moved the watermark"""
+        self.migration._start()
+        self.migration._checkpoint(42)
+        self.assertTrue(self.migration._lock())
+        self.assertTrue(self.migration._lock(42))
+        self.env.cr.execute(
+            "UPDATE object_storage_migration SET watermark = 84 WHERE id = %s",
+            (self.migration.id,),
+        )
+        self.assertFalse(self.migration._lock(42))
+
+    def test_start_new_pass(self):
+        """A finished pass is not resumed, the next one starts over"""
+        self.migration._start()
+        self.migration._checkpoint(42, done=1)
+        self.migration._finish()
+        self.assertFalse(self.migration._start())
+        self.assertEqual(self.migration.watermark, 0)
+        self.assertEqual(self.migration.done_count, 0)
+        self.assertFalse(self.migration.since)
+        # resumed once interrupted
+        self.migration._checkpoint(42)
+        self.assertTrue(self.migration._start())
+        self.assertEqual(self.migration.watermark, 42)
+        self.assertEqual(self.migration._domain(), [("id", ">", 42)])
+
+    def test_incremental_pass(self):
+        self.migration._start()
+        self.migration._finish()
+        last_start = self.migration.last_success_start
+        self.migration._start(incremental=True)
+        self.assertEqual(
+            self.migration.since,
+            last_start - object_storage_migration.INCREMENTAL_MARGIN,
+        )
+        self.assertEqual(
+            self.migration._domain(),
+            [("id", ">", 0), ("write_date", ">=", self.migration.since)],
+        )
+
+    def test_failed_pass_is_not_a_success(self):
+        self.migration._start()
+        self.migration._checkpoint(42, failed=1)
+        # a watermark never goes back
+        self.migration._checkpoint(21)
+        self.assertEqual(self.migration.watermark, 42)
+        self.migration._finish()
+        self.assertEqual(self.migration.state, "done")
+        self.assertFalse(self.migration.last_success_start)
@@ -0,0 +1,114 @@
+# Copyright 2017-2019 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+import gzip
+import hashlib
+from types import SimpleNamespace
+from unittest import mock
+
+from werkzeug.test import EnvironBuilder
+from werkzeug.wrappers import Request
+
+from odoo.tests.common import BaseCase
+
+from odoo.addons.base_attachment_object_storage.models import ir_binary
+
+CONTENT = b"content of the attachment"
+CHECKSUM = hashlib.sha1(CONTENT).hexdigest()
+
+
+class FakeAttachment(object):
+    """Files of an object storage, kept in memory"""
+
+    def __init__(self, files, redirect_url=None):
+        self.files = files
+        self.redirect_url = redirect_url
+        self.reads = []
+
+    def _file_read_iter(self, fname, start=0, decode=True):
+        self.reads.append((fname, start, decode))
+        content = self.files.get(fname, b"")[start:]
+        return iter([content[i : i + 4] for i in range(0, len(content), 4)])
+
+    def _store_file_redirect_url(self, fname, **kwargs):
+        return self.redirect_url
+
+
+class TestObjectStorageStream(BaseCase):
+    def _get_response(self, attachment, store_fname, headers=None, **kwargs):
+        environ = EnvironBuilder(path="/web/content", headers=headers).get_environ()
+        request = SimpleNamespace(httprequest=Request(environ))
+        stream = ir_binary.ObjectStorageStream(
+            attachment=attachment,
+            store_fname=store_fname,
+            mimetype="application/pdf",
+            download_name="file.pdf",
+            conditional=True,
+            etag=CHECKSUM,
+            size=len(CONTENT),
+            **kwargs,
+        )
+        with mock.patch.object(ir_binary, "request", request):
+            response = stream.get_response()
+        self.addCleanup(response.close)
+        return response
+
+    def test_stream(self):
+        attachment = FakeAttachment({"fake://abcd": CONTENT})
+        response = self._get_response(attachment, "fake://abcd")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content_length, len(CONTENT))
+        self.assertEqual(response.get_etag()[0], CHECKSUM)
+        self.assertEqual(b"".join(response.response), CONTENT)
+
+    def test_range(self):
+        """Only the requested range is read from the object storage"""
+        attachment = FakeAttachment({"fake://abcd": CONTENT})
+        response = self._get_response(
+            attachment, "fake://abcd", headers={"Range": "bytes=3-6"}
+        )
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(
+            response.headers["Content-Range"], "bytes 3-6/%d" % len(CONTENT)
+        )
+        self.assertEqual(b"".join(response.response), CONTENT[3:7])
+        self.assertEqual(attachment.reads, [("fake://abcd", 3, True)])
+
+    def test_not_modified(self):
+        """A conditional request matching the checksum reads nothing"""
+        attachment = FakeAttachment({"fake://abcd": CONTENT})
+        response = self._get_response(
+            attachment, "fake://abcd", headers={"If-None-Match": '"%s"' % CHECKSUM}
+        )
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(attachment.reads, [])
+
+    def test_missing_file(self):
+        attachment = FakeAttachment({})
+        response = self._get_response(attachment, "fake://abcd")
+        self.assertEqual(response.status_code, 404)
+        self.assertTrue(response.cache_control.no_store)
+
+    def test_compressed(self):
+        """Compressed files are sent as stored to the clients accepting them"""
+        compressed = gzip.compress(CONTENT)
+        attachment = FakeAttachment({"fake://abcd~gzip": compressed})
+        response = self._get_response(
+            attachment, "fake://abcd~gzip", headers={"Accept-Encoding": "gzip"}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        self.assertEqual(response.get_etag()[0], "%s-gzip" % CHECKSUM)
+        self.assertIn("Accept-Encoding", response.vary)
+        self.assertEqual(b"".join(response.response), compressed)
+        self.assertEqual(attachment.reads, [("fake://abcd~gzip", 0, False)])
+
+    def test_redirect(self):
+        attachment = FakeAttachment(
+            {"fake://abcd": CONTENT}, redirect_url="https://store/abcd?sig=1"
+        )
+        response = self._get_response(attachment, "fake://abcd", redirect=True)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response.location, "https://store/abcd?sig=1")
+        self.assertTrue(response.cache_control.no_store)
+        self.assertEqual(attachment.reads, [])
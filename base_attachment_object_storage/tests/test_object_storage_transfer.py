@@ -0,0 +1,129 @@
+# Copyright 2017-2019 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+import hashlib
+from unittest import mock
+
+from odoo import exceptions
+from odoo.tests.common import TransactionCase
+
+from odoo.addons.base_attachment_object_storage.models.ir_attachment import (
+    known_files,
+)
+
+
+class FakeStore(object):
+    """Files of the stores ``src`` and ``dst``, kept in memory"""
+
+    def __init__(self):
+        self.files = {}
+        self.deleted = []
+
+    def patch(self, model_class):
+        store = self
+
+        def _store_file_name(self, key):
+            return "dst://%s" % key
+
+        def _store_file_exists(self, fname):
+            return fname in store.files
+
+        def _store_file_read(self, fname):
+            return store.files.get(fname, b"")
+
+        def _store_file_read_iter(self, fname, start=0, chunk_size=None):
+            content = store.files.get(fname, b"")[start:]
+            chunk_size = chunk_size or 4
+            return iter(
+                [
+                    content[i : i + chunk_size]
+                    for i in range(0, len(content), chunk_size)
+                ]
+            )
+
+        def _store_file_write(self, key, bin_data):
+            store.files["dst://%s" % key] = bin_data
+            return "dst://%s" % key
+
+        def _store_file_write_fileobj(self, key, fileobj, size):
+            return _store_file_write(self, key, fileobj.read())
+
+        def _store_file_copy(self, fname, key):
+            return _store_file_write(self, key, store.files[fname])
+
+        def _store_file_delete(self, fname):
+            store.deleted.append(fname)
+            store.files.pop(fname, None)
+
+        return mock.patch.multiple(
+            model_class,
+            _store_file_name=_store_file_name,
+            _store_file_exists=_store_file_exists,
+            _store_file_read=_store_file_read,
+            _store_file_read_iter=_store_file_read_iter,
+            _store_file_write=_store_file_write,
+            _store_file_write_fileobj=_store_file_write_fileobj,
+            _store_file_copy=_store_file_copy,
+            _store_file_delete=_store_file_delete,
+        )
+
+
+class TestObjectStorageTransfer(TransactionCase):
+    def setUp(self):
+        super().setUp()
+        # the files written by a previous test must be written again
+        known_files.clear()
+        self.addCleanup(known_files.clear)
+        self.Attachment = self.env["ir.attachment"]
+        self.store = FakeStore()
+        patcher = self.store.patch(type(self.Attachment))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.content = b"content of the attachment"
+        self.checksum = hashlib.sha1(self.content).hexdigest()
+        self.key = self.Attachment._object_storage_key(self.checksum)
+
+    def test_transfer_file(self):
+        self.store.files["src://old"] = self.content
+        new_fname = self.Attachment._object_storage_transfer_file(
+            "src://old", self.checksum, len(self.content)
+        )
+        self.assertEqual(new_fname, "dst://%s" % self.key)
+        self.assertEqual(self.store.files[new_fname], self.content)
+        # the source is kept, the temporary file is deleted
+        self.assertEqual(self.store.files["src://old"], self.content)
+        self.assertEqual(len(self.store.deleted), 1)
+        self.assertTrue(self.store.deleted[0].startswith("dst://tmp/"))
+        self.assertEqual(set(self.store.files), {"src://old", new_fname})
+
+    def test_transfer_file_checksum_mismatch(self):
+        """A corrupted source is not written under the key of the content"""
+        self.store.files["src://old"] = b"corrupted content of the file"
+        with self.assertRaises(exceptions.UserError):
+            self.Attachment._object_storage_transfer_file(
+                "src://old", self.checksum, len(self.content)
+            )
+        self.assertNotIn("dst://%s" % self.key, self.store.files)
+        self.assertNotIn("dst://%s" % self.key, known_files)
+        # the temporary file is deleted
+        self.assertEqual(len(self.store.deleted), 1)
+        self.assertTrue(self.store.deleted[0].startswith("dst://tmp/"))
+        self.assertEqual(set(self.store.files), {"src://old"})
+
+    def test_transfer_file_truncated(self):
+        self.store.files["src://old"] = self.content[:-1]
+        with self.assertRaises(exceptions.UserError):
+            self.Attachment._object_storage_transfer_file(
+                "src://old", self.checksum, len(self.content)
+            )
+        self.assertEqual(set(self.store.files), {"src://old"})
+
+    def test_transfer_file_existing_target(self):
+        """A file already on the target is used as is, not overwritten"""
+        self.store.files["src://old"] = self.content
+        self.store.files["dst://%s" % self.key] = self.content
+        new_fname = self.Attachment._object_storage_transfer_file(
+            "src://old", self.checksum, len(self.content)
+        )
+        self.assertEqual(new_fname, "dst://%s" % self.key)
+        self.assertEqual(self.store.deleted, [])
@@ -0,0 +1,110 @@
+# Copyright 2017-2019 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+import os
+from unittest import mock
+
+from odoo.tests.common import TransactionCase
+from odoo.tools.misc import Callbacks
+
+from odoo.addons.base_attachment_object_storage.models.ir_attachment import (
+    known_files,
+)
+
+
+class Rollback(Exception):
+    pass
+
+
+class TestObjectStorageWriteBehind(TransactionCase):
+    def setUp(self):
+        super().setUp()
+        # the files written by a previous test must be written again
+        known_files.clear()
+        self.addCleanup(known_files.clear)
+        self.Attachment = self.env["ir.attachment"]
+        self.cron = self.env.ref(
+            "base_attachment_object_storage.ir_cron_object_storage_upload"
+        )
+        self.written = []
+
+        def _store_file_name(self, key):
+            return "fake://%s" % key
+
+        def _store_file_write(this, key, bin_data):
+            self.written.append(key)
+            return "fake://%s" % key
+
+        patchers = [
+            mock.patch.dict(os.environ, {"ODOO_ATTACHMENT_WRITE_BEHIND": "1"}),
+            mock.patch.multiple(
+                type(self.Attachment),
+                _storage=lambda self: "fake",
+                _get_stores=lambda self: ["fake"],
+                _store_file_name=_store_file_name,
+                _store_file_write=_store_file_write,
+            ),
+            # the callbacks run after the commit, or dropped by a rollback
+            mock.patch.object(self.env.cr, "postcommit", Callbacks()),
+            # the pass of the cron commits after each chunk
+            mock.patch.object(self.env.cr, "commit"),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        # the cron workers are woken up at the commit
+        patcher = mock.patch.object(type(self.env["ir.cron"]), "_notifydb")
+        self.notifydb = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _create(self, content):
+        return self.Attachment.create(
+            {"name": "staged.pdf", "raw": content, "mimetype": "application/pdf"}
+        )
+
+    def _key(self, content):
+        return self.Attachment._object_storage_key(
+            self.Attachment._compute_checksum(content)
+        )
+
+    def _triggers(self):
+        return self.env["ir.cron.trigger"].search_count(
+            [("cron_id", "=", self.cron.id)]
+        )
+
+    def test_commit_uploads_once(self):
+        """The staged content is uploaded by the cron, after the commit"""
+        triggers = self._triggers()
+        attachment = self._create(b"staged content")
+        self._create(b"other staged content")
+        # staged in the database, nothing is sent before the commit
+        self.assertEqual(self.written, [])
+        self.assertFalse(attachment.store_fname)
+        self.assertEqual(attachment.raw, b"staged content")
+        # the cron is triggered once per transaction
+        self.assertEqual(self._triggers(), triggers + 1)
+        self.notifydb.assert_not_called()
+        self.env.cr.postcommit.run()
+        self.notifydb.assert_called_once_with()
+        # run by the cron
+        self.Attachment._object_storage_upload_staged()
+        self.assertEqual(self.written.count(self._key(b"staged content")), 1)
+        attachment.invalidate_recordset()
+        self.assertEqual(
+            attachment.store_fname, "fake://%s" % self._key(b"staged content")
+        )
+        self.assertFalse(attachment.db_datas)
+        # the next runs do not upload it again
+        self.Attachment._object_storage_upload_staged()
+        self.assertEqual(self.written.count(self._key(b"staged content")), 1)
+
+    def test_rollback_discards_upload(self):
+        """A staged content rolled back never reaches the store"""
+        triggers = self._triggers()
+        with self.assertRaises(Rollback), self.env.cr.savepoint():
+            self._create(b"rolled back content")
+            raise Rollback()
+        self.env.invalidate_all()
+        self.assertEqual(self._triggers(), triggers)
+        self.Attachment._object_storage_upload_staged()
+        self.assertNotIn(self._key(b"rolled back content"), self.written)
@@ -0,0 +1,76 @@
+# Copyright 2017-2019 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+from odoo.tests.common import TransactionCase
+
+from odoo.addons.base_attachment_object_storage.routing import (
+    ROUTE_DB,
+    ROUTE_FILE,
+    StorageRoutingPolicy,
+    StorageRule,
+)
+
+
+class TestStorageRouting(TransactionCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.policy = StorageRoutingPolicy(
+            [
+                StorageRule(ROUTE_DB, res_model="res.partner"),
+                StorageRule(ROUTE_FILE, mimetype="video/", min_size=100),
+                StorageRule(ROUTE_DB, mimetype="image/", max_size=50, store="s3"),
+                StorageRule("azure", mimetype="application/pdf", store="swift"),
+                StorageRule(ROUTE_DB, max_size=10),
+            ]
+        )
+        values = []
+        for mimetype in ("image/png", "video/mp4", "application/pdf", "text/plain"):
+            for size in (5, 50, 200):
+                for res_model in (False, "res.partner", "res.users"):
+                    values.append(
+                        {
+                            "name": "{}-{}-{}".format(mimetype, size, res_model),
+                            "raw": b"x" * size,
+                            "mimetype": mimetype,
+                            "res_model": res_model,
+                        }
+                    )
+        cls.attachments = cls.env["ir.attachment"].create(values)
+
+    def test_route_and_domain_agree(self):
+        """The domain of a route selects the attachments routed to it"""
+        for store in ("s3", "swift", "azure"):
+            expected = {}
+            for attachment in self.attachments:
+                route = self.policy.route(
+                    store,
+                    attachment.file_size,
+                    attachment.mimetype,
+                    res_model=attachment.res_model,
+                )
+                expected.setdefault(route, self.attachments.browse())
+                expected[route] |= attachment
+            for route in (ROUTE_DB, ROUTE_FILE, "azure"):
+                found = self.attachments.search(
+                    self.policy.domain(store, route)
+                    + [("id", "in", self.attachments.ids)]
+                )
+                self.assertEqual(
+                    found,
+                    expected.get(route, self.attachments.browse()),
+                    "route {} of store {}".format(route, store),
+                )
+
+    def test_first_matching_rule_wins(self):
+        # the model rule comes before the video rule
+        self.assertEqual(
+            self.policy.route("s3", 200, "video/mp4", res_model="res.partner"),
+            ROUTE_DB,
+        )
+        self.assertEqual(self.policy.route("s3", 200, "video/mp4"), ROUTE_FILE)
+        # rules restricted to another store are ignored
+        self.assertEqual(self.policy.route("s3", 200, "application/pdf"), None)
+        self.assertEqual(self.policy.route("swift", 200, "application/pdf"), "azure")
+        self.assertEqual(self.policy.route("swift", 20, "image/png"), None)
+        self.assertEqual(self.policy.route("s3", 20, "image/png"), ROUTE_DB)
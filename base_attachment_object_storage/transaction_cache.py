@@ -0,0 +1,41 @@
+# Copyright 2017-2019 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+import threading
+from collections import OrderedDict
+
+
+class TransactionFilesCache(object):
+    """Contents of the files read by a transaction
+
+    A transaction often reads the same file several times (a logo on
+    every page of a report, a read followed by a write of the same
+    content...). The keys of the files are the checksums of their
+    content, so they can be kept without risk of staleness. The cache
+    keeps at most ``max_bytes`` bytes, the least recently used files
+    are dropped first.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._contents = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, fname):
+        with self._lock:
+            content = self._contents.get(fname)
+            if content is not None:
+                self._contents.move_to_end(fname)
+            return content
+
+    def put(self, fname, content):
+        size = len(content)
+        with self._lock:
+            if size > self.max_bytes or fname in self._contents:
+                return
+            self._contents[fname] = content
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                __, dropped = self._contents.popitem(last=False)
+                self._bytes -= len(dropped)
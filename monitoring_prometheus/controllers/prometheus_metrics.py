@@ -1,11 +1,41 @@
 # Copyright 2016-2021 Camptocamp SA
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
 
-from odoo.http import Controller, route
-from prometheus_client import generate_latest
+from odoo.http import Controller, request, route
+from prometheus_client import Gauge, generate_latest
+
+OBJECT_STORAGE = Gauge(
+    "object_storage",
+    "Counters of the object storages of the process",
+    ["component", "counter"],
+)
+
+
+def _flatten(counters, prefix=""):
+    for name, value in counters.items():
+        name = "%s%s" % (prefix, name)
+        if isinstance(value, dict):
+            yield from _flatten(value, prefix=name + ".")
+        elif isinstance(value, (int, float)):
+            yield name, value
+
+
+def update_object_storage_metrics(env):
+    """Copy the counters of the object storages in the gauges
+
+    They are provided by base_attachment_object_storage and the stores
+    modules, when they are installed.
+    """
+    attachment = env["ir.attachment"].sudo()
+    if not hasattr(attachment, "_object_storage_stats"):
+        return
+    for component, counters in attachment._object_storage_stats().items():
+        for counter, value in _flatten(counters):
+            OBJECT_STORAGE.labels(component, counter).set(value)
 
 
 class PrometheusController(Controller):
     @route('/metrics', auth='public')
     def metrics(self):
+        update_object_storage_metrics(request.env)
         return generate_latest()